@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks of terminal.color.
+
+    Run it with ``python benchmarks/bench_color.py``.
+"""
+
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from terminal import color  # noqa
+
+
+def bench(name, func, number=1):
+    elapsed = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print('%-40s %10.2f ms' % (name, elapsed * 1000))
+    return elapsed
+
+
+def bench_rgb2ansi(count=100000):
+    colors = [
+        (random.randrange(256), random.randrange(256), random.randrange(256))
+        for i in range(count)
+    ]
+    hexes = ['%02x%02x%02x' % rgb for rgb in colors]
+
+    print('Convert %i colors' % count)
+    base = bench('rgb2ansi', lambda: [color.rgb2ansi(*c) for c in colors])
+
+    numpy = color._get_numpy()
+    color._numpy = False
+    fast = bench('rgb2ansi_array (lookup table)',
+                 lambda: color.rgb2ansi_array(colors))
+    color._numpy = numpy
+    print('%-40s %10.1fx' % ('speedup', base / fast))
+
+    if numpy is not None:
+        arr = numpy.array(colors, dtype=numpy.uint8)
+        fast = bench('rgb2ansi_array (numpy)',
+                     lambda: color.rgb2ansi_array(arr))
+        print('%-40s %10.1fx' % ('speedup', base / fast))
+
+    base = bench('hex2ansi', lambda: [color.hex2ansi(c) for c in hexes])
+    fast = bench('hex2ansi_many', lambda: color.hex2ansi_many(hexes))
+    print('%-40s %10.1fx' % ('speedup', base / fast))
+
+
+def bench_concat(count=20000):
+    def build():
+        line = color.Color('')
+        for i in range(count):
+            line = line + color.red('x') + ' '
+        return line
+
+    print('Concatenate and render %i fragments' % count)
+    with color.override_profile(depth=color.TerminalProfile.ANSI256):
+        bench('build', build)
+        line = build()
+        bench('render', lambda: str(line))
+
+
+def bench_template(count=100000):
+    print('Format %i lines' % count)
+    with color.override_profile(depth=color.TerminalProfile.ANSI256):
+        def build():
+            for i in range(count):
+                line = color.red('error').bold + ' ' + color.cyan('key')
+                str(line + '=' + str(i))
+
+        template = color.compile('{level:bold.red} {key:cyan}={value}')
+
+        def render():
+            for i in range(count):
+                template(level='error', key='key', value=i)
+
+        base = bench('Color', build)
+        fast = bench('compile', render)
+        print('%-40s %10.1fx' % ('speedup', base / fast))
+
+
+def bench_image(width=200, height=100):
+    numpy = color._get_numpy()
+    if numpy is None:
+        return
+
+    print('Render %ix%i images' % (width, height))
+    y, x = numpy.mgrid[0:height, 0:width]
+    images = {
+        'chart': numpy.repeat(numpy.where(x // 20 % 2, 200, 30)[..., None],
+                              3, axis=-1),
+        'gradient': numpy.stack([
+            x * 255 // (width - 1),
+            y * 255 // (height - 1),
+            numpy.full_like(x, 128),
+        ], -1),
+    }
+    for name in sorted(images):
+        for depth in (256, color.TerminalProfile.TRUECOLOR):
+            profile = color.TerminalProfile(depth=depth)
+            bench('%s (depth %i)' % (name, depth),
+                  lambda: color.render_image(images[name], profile), 10)
+
+
+if __name__ == '__main__':
+    bench_rgb2ansi()
+    bench_concat()
+    bench_template()
+    bench_image()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks of terminal.log.
+
+    Run it with ``python benchmarks/bench_log.py``.
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from terminal import Logger  # noqa
+from terminal.log import format_json, _json_fields  # noqa
+
+
+class NullSink(object):
+    def emit(self, level, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+def run_threads(log, threads, count):
+    def work():
+        for i in range(count):
+            log.start('start', i)
+            log.info('%s of %s', i, count)
+            log.warn('warn', i)
+            log.end()
+
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    begin = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.time() - begin
+
+
+def bench_threads(count=20000):
+    print('Log %i records in each thread' % (count * 3))
+    for threads in (1, 8, 32):
+        for concurrent in (False, True):
+            log = Logger(sink=NullSink(), concurrent=concurrent)
+            elapsed = run_threads(log, threads, count)
+            total = threads * count * 3
+            name = '%i threads%s' % (
+                threads, ' (concurrent)' if concurrent else '')
+            print('%-40s %10.0f records/s' % (name, total / elapsed))
+
+    print('Write %i records to devnull in each thread' % (count * 3))
+    stdout = sys.stdout
+    for threads in (1, 8, 32):
+        log = Logger(concurrent=True)
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            elapsed = run_threads(log, threads, count)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        total = threads * count * 3
+        print('%-40s %10.0f records/s' % (
+            '%i threads (concurrent)' % threads, total / elapsed))
+
+
+def bench_filtered(count=1000000):
+    log = Logger(sink=NullSink(), quiet=True)
+    data = list(range(100))
+    print('Filter %i debug logs' % count)
+    begin = time.time()
+    for i in range(count):
+        log.debug('%r', data)
+        log.verbose.info('%r', data)
+    elapsed = (time.time() - begin) / count / 2
+    print('%-40s %10.0f ns' % ('filtered log', elapsed * 1e9))
+
+    # a filtered call should cost about a call of a function doing nothing
+    def noop(*args, **extra):
+        return log
+
+    debug = log.debug
+    for name, func in (('no-op function', noop),
+                       ('quiet debug', debug)):
+        def run():
+            for i in range(count):
+                func('%r', data)
+
+        elapsed = min(timeit.repeat(run, number=1, repeat=3)) / count
+        print('%-40s %10.0f ns' % (name, elapsed * 1e9))
+
+
+def bench_json(count=100000):
+    extra = {'app': 'bench', 'size': 1024}
+    now = time.time()
+
+    def dumps():
+        for i in range(count):
+            record = {'ts': now, 'level': 'info', 'msg': 'uploaded',
+                      'indent': 1}
+            record.update(extra)
+            json.dumps(record, separators=(',', ':'))
+
+    def encode():
+        for i in range(count):
+            format_json('info', 'uploaded', 1, now, extra)
+
+    def encode_fields():
+        # the extra fields of Logger.config are encoded once
+        fields = _json_fields(extra)
+        for i in range(count):
+            format_json('info', 'uploaded', 1, now, fields)
+
+    print('Encode %i JSON records' % count)
+    base = min(timeit.repeat(dumps, number=1, repeat=3))
+    print('%-40s %10.2f ms' % ('json.dumps', base * 1000))
+    for name, func in (('format_json', encode),
+                       ('format_json (encoded extra)', encode_fields)):
+        fast = min(timeit.repeat(func, number=1, repeat=3))
+        print('%-40s %10.2f ms' % (name, fast * 1000))
+        print('%-40s %10.1fx' % ('speedup', base / fast))
+
+
+def bench_spans(count=100000):
+    print('Start and end %i nested logs' % count)
+    for timing in (False, True):
+        log = Logger(sink=NullSink(), timing=timing)
+
+        def spans():
+            for i in range(count):
+                log.start('step')
+                log.end('done')
+
+        elapsed = min(timeit.repeat(spans, number=1, repeat=3)) / count
+        name = 'start/end%s' % (' (timing)' if timing else '')
+        print('%-40s %10.0f ns' % (name, elapsed * 1e9))
+
+
+def bench_sampling(count=100000):
+    print('Log %i debug logs with sampling' % count)
+    data = list(range(100))
+    for sample in (1, 100, 0.01):
+        log = Logger(sink=NullSink(), sample={'debug': sample})
+
+        def run():
+            for i in range(count):
+                log.debug('%r', data)
+
+        elapsed = min(timeit.repeat(run, number=1, repeat=3)) / count
+        print('%-40s %10.0f ns' % ('sample %s' % sample, elapsed * 1e9))
+
+
+if __name__ == '__main__':
+    bench_threads()
+    bench_filtered()
+    bench_json()
+    bench_spans()
+    bench_sampling()
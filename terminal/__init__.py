@@ -14,7 +14,7 @@ from __future__ import absolute_import
 
 from .color import *
 from .prompt import *
-from .log import Logger
+from .log import Logger, lazy
 from .command import Command, Option
 
 log = Logger()
@@ -2,28 +2,30 @@
 
 from . import color
 from .command import Command as _Command
-from .log import Logger as _Logger
+from .log import Logger as _Logger, format_args
+
+
+_level_colors = {
+    'debug': 'gray',
+    'info': 'green',
+    'warn': 'yellow',
+    'error': 'red',
+    'end': 'white',
+}
 
 
 class Logger(_Logger):
     def message(self, level, *args):
-        msg = ' '.join((str(o) for o in args))
+        msg = format_args(args)
 
         if level == 'start':
             return color.bold(msg)
-        _ = {
-            'debug': 'gray',
-            'info': 'green',
-            'warn': 'yellow',
-            'error': 'red',
-            'end': 'white',
-        }
 
         if level == 'error':
             msg = color.red(msg)
 
-        if level in _:
-            fn = getattr(color, _[level])
+        if level in _level_colors:
+            fn = getattr(color, _level_colors[level])
             return '%s %s' % (fn('*'), msg)
         return msg
 
@@ -13,7 +13,12 @@
 # https://gist.github.com/MicahElliott/719710
 
 import os
+import re
 import sys
+import string
+import threading
+import unicodedata
+from bisect import bisect_right
 
 # Python 3
 if sys.version_info[0] == 3:
@@ -22,37 +27,226 @@ if sys.version_info[0] == 3:
 else:
     string_type = (unicode, str)
 
+try:
+    from contextvars import ContextVar
+except ImportError:  # pragma: no cover
+    ContextVar = None
 
-def is_color_supported():
-    "Find out if your terminal environment supports color."
+# compile is left out, it would shadow the builtin on a star import
+__all__ = [
+    'TerminalProfile', 'get_profile', 'refresh_profile', 'override_profile',
+    'is_color_supported', 'is_256color_supported', 'rgb2ansi', 'hex2ansi',
+    'rgb2ansi_array', 'hex2ansi_many', 'ansi2rgb', 'ansi2hex', 'quantize',
+    'Style', 'Color', 'PlainText', 'render_spans', 'strip_ansi',
+    'visible_width', 'write_buffers', 'ByteWriter', 'Template', 'iter_image',
+    'render_image', 'colorize', 'set_color_mode', 'bold', 'faint', 'italic',
+    'underline', 'blink', 'overline', 'inverse', 'conceal', 'strike', 'black',
+    'red', 'green', 'yellow', 'blue', 'magenta', 'cyan', 'white', 'gray',
+    'grey', 'black_bg', 'red_bg', 'green_bg', 'yellow_bg', 'blue_bg',
+    'magenta_bg', 'cyan_bg', 'white_bg', 'gray_bg', 'grey_bg',
+]
+
+
+class _LocalVar(object):
+    """Thread local replacement of ContextVar for old Pythons."""
+
+    def __init__(self, name, default=None):
+        self._local = threading.local()
+        self._default = default
+
+    def get(self):
+        return getattr(self._local, 'value', self._default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+
+class TerminalProfile(object):
+    """
+    The capabilities of an output stream.
+
+    Probing a terminal costs a few syscalls and environ lookups, which
+    adds up when rendering many colored strings. A profile is probed
+    once per stream and cached, get it with :func:`get_profile`::
+
+        profile = get_profile()
+        if profile.depth >= TerminalProfile.ANSI256:
+            print('256 colors')
+
+    :param stream: the output stream, default is ``sys.stdout``
+    :param depth: force the color depth instead of probing
+    :param isatty: force the tty flag instead of probing
+    :param encoding: force the encoding instead of probing
+    """
+
+    #: no color support
+    NONE = 0
+    #: the 8 ANSI colors
+    ANSI = 8
+    #: the xterm 256 colors
+    ANSI256 = 256
+    #: 24-bit RGB colors
+    TRUECOLOR = 1 << 24
+
+    def __init__(self, stream=None, depth=None, isatty=None, encoding=None):
+        if stream is None:
+            stream = sys.stdout
+        self.stream = stream
+        self._overrides = dict(depth=depth, isatty=isatty, encoding=encoding)
+        self.refresh()
+
+    def __repr__(self):
+        return '<TerminalProfile depth=%i isatty=%r encoding=%r>' % (
+            self.depth, self.isatty, self.encoding
+        )
+
+    def refresh(self):
+        """
+        Probe the stream and the environment again.
+        """
+
+        stream = self.stream
+        overrides = self._overrides
+
+        isatty = overrides['isatty']
+        if isatty is None:
+            isatty = hasattr(stream, 'isatty') and stream.isatty()
+        self.isatty = isatty
+
+        encoding = overrides['encoding']
+        if encoding is None:
+            encoding = getattr(stream, 'encoding', None) or 'utf-8'
+        self.encoding = encoding
+
+        depth = overrides['depth']
+        if depth is None:
+            depth = _probe_depth(stream, isatty)
+        self.depth = depth
+        return self
+
+    def replace(self, **kwargs):
+        """
+        Create a new profile of the same stream with some capabilities
+        overridden.
+        """
+
+        overrides = dict(
+            depth=self.depth, isatty=self.isatty, encoding=self.encoding
+        )
+        overrides.update(kwargs)
+        return TerminalProfile(self.stream, **overrides)
+
+
+def _probe_depth(stream, isatty):
     # shinx.util.console
-    if not hasattr(sys.stdout, 'isatty'):
-        return False
+    if not hasattr(stream, 'isatty'):
+        return TerminalProfile.NONE
 
-    if not sys.stdout.isatty() and 'TERMINAL-COLOR' not in os.environ:
-        return False
+    if not isatty and 'TERMINAL-COLOR' not in os.environ:
+        return TerminalProfile.NONE
+
+    term = os.environ.get('TERM', 'dumb').lower()
 
     if sys.platform == 'win32':  # pragma: no cover
         try:
             import colorama
             colorama.init()
-            return True
         except ImportError:
-            return False
+            return TerminalProfile.NONE
+    elif 'COLORTERM' not in os.environ:
+        if term not in ('xterm', 'linux') and 'color' not in term:
+            return TerminalProfile.NONE
 
-    if 'COLORTERM' in os.environ:
-        return True
+    colorterm = os.environ.get('COLORTERM', '').lower()
+    if colorterm in ('truecolor', '24bit'):
+        return TerminalProfile.TRUECOLOR
+    if '256' in term:
+        return TerminalProfile.ANSI256
+    return TerminalProfile.ANSI
 
-    term = os.environ.get('TERM', 'dumb').lower()
-    return term in ('xterm', 'linux') or 'color' in term
+
+_profiles = {}
+if ContextVar is not None:
+    _profile_override = ContextVar('terminal_profile', default=None)
+else:  # pragma: no cover
+    _profile_override = _LocalVar('terminal_profile')
+
+
+def get_profile(stream=None):
+    """
+    Get the cached :class:`TerminalProfile` of a stream.
+
+    :param stream: the output stream, default is ``sys.stdout``
+    """
+
+    profile = _profile_override.get()
+    if profile is not None:
+        return profile
+
+    if stream is None:
+        stream = sys.stdout
+    profile = _profiles.get(id(stream))
+    if profile is None or profile.stream is not stream:
+        profile = _profiles[id(stream)] = TerminalProfile(stream)
+    return profile
+
+
+def refresh_profile(stream=None):
+    """
+    Drop the cached profiles, they will be probed again on next use.
+
+    Call it after changing the environment, e.g. ``TERM``.
+
+    :param stream: only refresh this stream, default is all streams
+    """
+
+    if stream is None:
+        _profiles.clear()
+    else:
+        _profiles.pop(id(stream), None)
+
+
+class override_profile(object):
+    """
+    Override the profile in the current thread or context, which is
+    useful in tests::
+
+        with override_profile(depth=TerminalProfile.ANSI256):
+            assert is_256color_supported()
+
+    :param profile: a :class:`TerminalProfile` to use
+    :param kwargs: capabilities to override on the current profile
+    """
+
+    def __init__(self, profile=None, **kwargs):
+        if profile is None:
+            profile = get_profile()
+        if kwargs:
+            profile = profile.replace(**kwargs)
+        self.profile = profile
+        self._token = None
+
+    def __enter__(self):
+        self._token = _profile_override.set(self.profile)
+        return self.profile
+
+    def __exit__(self, *args):
+        _profile_override.reset(self._token)
+
+
+def is_color_supported():
+    "Find out if your terminal environment supports color."
+    return get_profile().depth > 0
 
 
 def is_256color_supported():
     "Find out if your terminal environment supports 256 color."
-    if not is_color_supported():
-        return False
-    term = os.environ.get('TERM', 'dumb').lower()
-    return '256' in term
+    return get_profile().depth >= TerminalProfile.ANSI256
 
 
 def rgb2ansi(r, g, b):
@@ -86,18 +280,289 @@ def hex2ansi(code):
     Convert hex code to ansi.
     """
 
+    return rgb2ansi(*_hex2rgb(code))
+
+
+# NumPy is slow to import, it is imported on first use
+_numpy = None
+
+
+def _get_numpy():
+    # the numpy module, or None if it is not installed
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:  # pragma: no cover
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def _build_channel_tables():
+    # the grayscale bucket of rgb2ansi's stepping loop,
+    # and the 6 levels color cube index of each channel value
+    buckets = []
+    cubes = []
+    for val in range(256):
+        bucket = 0
+        step = 2.5
+        while val >= step:
+            bucket += 1
+            step += 42.5
+        buckets.append(bucket)
+        cubes.append(int(6 * float(val) / 256))
+    return buckets, cubes
+
+
+_buckets, _cubes = _build_channel_tables()
+
+
+def _rgb2ansi_lut(r, g, b):
+    buckets = _buckets
+    if buckets[r] == buckets[g] == buckets[b]:
+        return 232 + (r + g + b) // 33
+    cubes = _cubes
+    return 16 + 36 * cubes[r] + 6 * cubes[g] + cubes[b]
+
+
+def _is_byte(val):
+    return val.__class__ is int and 0 <= val <= 255
+
+
+def rgb2ansi_array(colors):
+    """
+    Convert a batch of RGB colors to 256 ansi graphics.
+
+    The results are identical to :func:`rgb2ansi`, but it is much faster
+    for many colors. With NumPy, it accepts an array in the shape of
+    ``(..., 3)`` and returns an array in the shape of ``(...)``::
+
+        rgb2ansi_array(numpy.array([[255, 0, 0], [80, 80, 80]]))
+
+    Without NumPy, it accepts a sequence of RGB tuples and returns a list.
+
+    :param colors: the RGB colors
+    """
+
+    numpy = _get_numpy()
+    if numpy is not None:
+        arr = numpy.asarray(colors)
+        if arr.shape[-1:] != (3,):
+            raise ValueError('invalid color array shape: %r' % (arr.shape,))
+
+        if arr.size and (
+                arr.dtype.kind not in 'iub' or
+                arr.min() < 0 or arr.max() > 255):
+            # out of the lookup tables, delegate to the slow path
+            flat = arr.reshape(-1, 3).tolist()
+            rv = numpy.array([rgb2ansi(*rgb) for rgb in flat], dtype=int)
+            return rv.reshape(arr.shape[:-1])
+
+        arr = arr.astype(numpy.intp)
+        r, g, b = arr[..., 0], arr[..., 1], arr[..., 2]
+        buckets = numpy.array(_buckets, dtype=numpy.intp)
+        cubes = numpy.array(_cubes, dtype=numpy.intp)
+        br = buckets[r]
+        grayscale = (br == buckets[g]) & (br == buckets[b])
+        gray = 232 + (r + g + b) // 33
+        cube = 16 + 36 * cubes[r] + 6 * cubes[g] + cubes[b]
+        return numpy.where(grayscale, gray, cube)
+
+    rv = []
+    for rgb in colors:
+        r, g, b = rgb
+        if _is_byte(r) and _is_byte(g) and _is_byte(b):
+            rv.append(_rgb2ansi_lut(r, g, b))
+        else:
+            rv.append(rgb2ansi(r, g, b))
+    return rv
+
+
+def _hex2rgb(code):
     if code.startswith('#'):
         code = code[1:]
 
     if len(code) == 3:
         # efc -> eeffcc
-        return rgb2ansi(*map(lambda o: int(o * 2, 16), code))
-
-    if len(code) != 6:
+        code = code[0] * 2 + code[1] * 2 + code[2] * 2
+    elif len(code) != 6:
         raise ValueError('invalid color code')
 
-    rgb = (code[:2], code[2:4], code[4:])
-    return rgb2ansi(*map(lambda o: int(o, 16), rgb))
+    value = int(code, 16)
+    return value >> 16, (value >> 8) & 0xff, value & 0xff
+
+
+def hex2ansi_many(codes):
+    """
+    Convert a batch of hex codes to ansi, identical to :func:`hex2ansi`::
+
+        hex2ansi_many(['#ff0000', 'f00', '505050'])
+
+    :param codes: an iterable of hex codes
+    :return: a list of ansi codes
+    """
+
+    cache = {}
+    rv = []
+    for code in codes:
+        ansi = cache.get(code)
+        if ansi is None:
+            ansi = cache[code] = _rgb2ansi_lut(*_hex2rgb(code))
+        rv.append(ansi)
+    return rv
+
+
+def _build_palette():
+    # the default xterm palette
+    palette = [
+        (0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0),
+        (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+        (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+        (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255),
+    ]
+    levels = (0, 95, 135, 175, 215, 255)
+    for r in levels:
+        for g in levels:
+            for b in levels:
+                palette.append((r, g, b))
+    for i in range(24):
+        palette.append((8 + i * 10,) * 3)
+    return palette
+
+
+_palette = _build_palette()
+
+
+def ansi2rgb(code):
+    """
+    Convert a 256 ansi color to RGB, in the default xterm palette.
+
+    :param code: the ansi color, 0 - 255
+    """
+
+    return _palette[code]
+
+
+def ansi2hex(code):
+    """
+    Convert a 256 ansi color to hex code, in the default xterm palette.
+
+    :param code: the ansi color, 0 - 255
+    """
+
+    return '#%02x%02x%02x' % _palette[code]
+
+
+def _build_linear_table():
+    # sRGB channel value to linear light
+    table = []
+    for val in range(256):
+        c = val / 255.0
+        if c <= 0.04045:
+            table.append(c / 12.92)
+        else:
+            table.append(((c + 0.055) / 1.055) ** 2.4)
+    return table
+
+
+_linear = _build_linear_table()
+
+
+def _lab_f(t):
+    if t > 0.008856:
+        return t ** (1.0 / 3)
+    return 7.787 * t + 16.0 / 116
+
+
+def _rgb2lab(r, g, b):
+    # sRGB to CIE L*a*b* under D65
+    r, g, b = _linear[r], _linear[g], _linear[b]
+    x = _lab_f((0.4124 * r + 0.3576 * g + 0.1805 * b) / 0.95047)
+    y = _lab_f(0.2126 * r + 0.7152 * g + 0.0722 * b)
+    z = _lab_f((0.0193 * r + 0.1192 * g + 0.9505 * b) / 1.08883)
+    return 116 * y - 16, 500 * (x - y), 200 * (y - z)
+
+
+def _build_kdtree(points, axis=0):
+    # points are (lab, code), a node is (lab, code, axis, left, right)
+    if not points:
+        return None
+    points.sort(key=lambda o: o[0][axis])
+    mid = len(points) // 2
+    lab, code = points[mid]
+    child = (axis + 1) % 3
+    return (
+        lab, code, axis,
+        _build_kdtree(points[:mid], child),
+        _build_kdtree(points[mid + 1:], child),
+    )
+
+
+def _search_kdtree(node, lab, best):
+    # best is [distance, code]
+    while node is not None:
+        point, code, axis, left, right = node
+        dist = (
+            (point[0] - lab[0]) ** 2 +
+            (point[1] - lab[1]) ** 2 +
+            (point[2] - lab[2]) ** 2
+        )
+        if dist < best[0] or (dist == best[0] and code < best[1]):
+            best[0] = dist
+            best[1] = code
+
+        diff = lab[axis] - point[axis]
+        if diff < 0:
+            near, far = left, right
+        else:
+            near, far = right, left
+        if far is not None and diff * diff <= best[0]:
+            _search_kdtree(far, lab, best)
+        node = near
+    return best
+
+
+_kdtrees = {}
+_quantized = {}
+
+
+def quantize(r, g, b, colors=256):
+    """
+    Find the nearest ansi color of an RGB color.
+
+    Unlike :func:`rgb2ansi`, it measures the perceptual distance in the
+    CIE L*a*b* color space, and it considers the 16 base colors too.
+    The palette is searched with a k-d tree, and the results are
+    memoized::
+
+        quantize(255, 0, 0)             # 9
+        quantize(255, 0, 0, colors=8)   # 1
+
+    :param r: red, 0 - 255
+    :param g: green, 0 - 255
+    :param b: blue, 0 - 255
+    :param colors: the palette size, 8, 16 or 256
+    """
+
+    key = (r, g, b, colors)
+    code = _quantized.get(key)
+    if code is not None:
+        return code
+
+    tree = _kdtrees.get(colors)
+    if tree is None:
+        if colors not in (8, 16, 256):
+            raise ValueError('invalid palette size: %s' % colors)
+        points = [(_rgb2lab(*rgb), i) for i, rgb in enumerate(_palette)]
+        tree = _kdtrees[colors] = _build_kdtree(points[:colors])
+
+    r, g, b = (min(max(int(val), 0), 255) for val in (r, g, b))
+    code = _search_kdtree(tree, _rgb2lab(r, g, b), [float('inf'), 0])[1]
+    if len(_quantized) >= 65536:
+        _quantized.clear()
+    _quantized[key] = code
+    return code
 
 
 _reset = '\x1b[0;39;49m'
@@ -112,15 +577,221 @@ _colors = (
 
 
 def _color2ansi(color):
+    # a color name to ansi, a hex or RGB color to an RGB tuple
     if color in _colors:
         return _colors.index(color)
 
     if isinstance(color, string_type):
-        return hex2ansi(color)
-    elif isinstance(color, (tuple, list)):
-        return rgb2ansi(*color)
+        return _hex2rgb(color)
+    elif isinstance(color, (tuple, list)) and len(color) == 3:
+        return tuple(int(val) for val in color)
+
+    raise ValueError('invalid color: %s' % (color,))
+
+
+def _color_code(color, depth, background=False):
+    # the SGR parameter of a normalized color, None if not renderable
+    if color is None or not depth:
+        return None
+
+    if isinstance(color, tuple):
+        if depth >= TerminalProfile.TRUECOLOR:
+            return '%i;2;%i;%i;%i' % ((background and 48 or 38,) + color)
+        if depth >= TerminalProfile.ANSI256:
+            color = quantize(*color)
+        else:
+            color = quantize(*color, colors=8)
+
+    if depth >= TerminalProfile.ANSI256:
+        return '%i;5;%i' % (background and 48 or 38, color)
+    if color >= 8:
+        # downsample to the nearest of the 8 colors
+        color = quantize(*_palette[color], colors=8)
+    return str((background and 40 or 30) + color)
+
+
+def _normalize_color(color):
+    if color is None or isinstance(color, int):
+        return color
+    return _color2ansi(color)
+
+
+# hex and RGB colors make new styles without end, the caches are
+# cleared when they reach the size like _quantized
+_style_cache_size = 4096
+_style_cache = {}
+_style_wraps = {}
+_style_wrap_bytes = {}
+_style_chains = {}
+_style_merges = {}
+
 
-    raise ValueError('invalid color: %s' % color)
+def _cache_style(cache, key, value):
+    if len(cache) >= _style_cache_size:
+        cache.clear()
+    cache[key] = value
+    return value
+
+
+class Style(tuple):
+    """
+    The immutable ``(fgcolor, bgcolor, styles)`` of a :class:`Color`.
+
+    Styles are interned, creating the same style twice returns the same
+    object, which is shared by all colors painted with it::
+
+        assert Style(1, None, (1,)) is Style('red', None, [1])
+
+    :param fgcolor: the foreground color
+    :param bgcolor: the background color
+    :param styles: the style codes, e.g. ``1`` for bold
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, fgcolor=None, bgcolor=None, styles=()):
+        if isinstance(fgcolor, list):
+            fgcolor = tuple(fgcolor)
+        if isinstance(bgcolor, list):
+            bgcolor = tuple(bgcolor)
+        key = (fgcolor, bgcolor, tuple(styles))
+        style = _style_cache.get(key)
+        if style is not None:
+            return style
+
+        normalized = (
+            _normalize_color(fgcolor), _normalize_color(bgcolor), key[2]
+        )
+        style = _style_cache.get(normalized)
+        if len(_style_cache) >= _style_cache_size:
+            _style_cache.clear()
+            # keep the plain style identical, colors compare it with is
+            _style_cache[_plain_style] = _plain_style
+        if style is None:
+            style = tuple.__new__(cls, normalized)
+            _style_cache[normalized] = style
+        _style_cache[key] = style
+        return style
+
+    def __repr__(self):
+        return 'Style(%r, %r, %r)' % self
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    @property
+    def fgcolor(self):
+        return self[0]
+
+    @property
+    def bgcolor(self):
+        return self[1]
+
+    @property
+    def styles(self):
+        return self[2]
+
+    def chain(self, name):
+        """
+        Get the style with a color or style name applied, which is
+        what ``Color('text').bold.red`` does.
+
+        :param name: a color, background or style name
+        """
+
+        key = (self, name)
+        style = _style_chains.get(key)
+        if style is not None:
+            return style
+
+        fgcolor, bgcolor, styles = self
+        if name.endswith('_bg') and name[:-3] in _colors:
+            bgcolor = _colors.index(name[:-3])
+        elif name in _colors:
+            fgcolor = _colors.index(name)
+        elif name in _styles:
+            styles = styles + (_styles.index(name) + 1,)
+        else:
+            raise AttributeError("Color has no attribute '%s'" % name)
+
+        return _cache_style(
+            _style_chains, key, Style(fgcolor, bgcolor, styles)
+        )
+
+    def merge(self, inner):
+        """
+        Merge the style of an inner color into this style.
+
+        :param inner: the inner style
+        """
+
+        key = (self, inner)
+        style = _style_merges.get(key)
+        if style is not None:
+            return style
+
+        fgcolor, bgcolor, styles = self
+        if inner[0] is not None:
+            fgcolor = inner[0]
+        if inner[1] is not None:
+            bgcolor = inner[1]
+        styles = styles + tuple(
+            code for code in inner[2] if code not in styles
+        )
+
+        return _cache_style(
+            _style_merges, key, Style(fgcolor, bgcolor, styles)
+        )
+
+    def wrap(self, depth):
+        """
+        Get the prefix and suffix escape codes to wrap text in.
+
+        :param depth: the color depth of the terminal
+        """
+
+        key = (self, depth)
+        wrap = _style_wraps.get(key)
+        if wrap is not None:
+            return wrap
+
+        fgcolor, bgcolor, styles = self
+        prefix = []
+        if depth and styles:
+            prefix.append('\x1b[%sm' % ';'.join(str(i) for i in styles))
+
+        for code in (_color_code(bgcolor, depth, True),
+                     _color_code(fgcolor, depth)):
+            if code is not None:
+                prefix.append('\x1b[%sm' % code)
+
+        wrap = (''.join(prefix), _reset * len(prefix))
+        return _cache_style(_style_wraps, key, wrap)
+
+    def wrap_bytes(self, depth):
+        """
+        Get the prefix and suffix escape codes of :meth:`wrap`,
+        encoded in bytes.
+
+        :param depth: the color depth of the terminal
+        """
+
+        key = (self, depth)
+        wrap = _style_wrap_bytes.get(key)
+        if wrap is None:
+            prefix, suffix = self.wrap(depth)
+            wrap = (prefix.encode('ascii'), suffix.encode('ascii'))
+            _cache_style(_style_wrap_bytes, key, wrap)
+        return wrap
+
+
+_plain_style = Style()
+_format_spec_re = re.compile(
+    r'^(?:(.)?([<>^]))?([1-9][0-9]*)?(?:\.([0-9]+))?s?$'
+)
+
+
+_extend_lock = threading.Lock()
 
 
 class Color(object):
@@ -136,83 +807,266 @@ class Color(object):
         s = Color('text')
         print(s.bold.red.italic)
 
-    All ANSI colors and styles are available on Color.
+    All ANSI colors and styles are available on Color. Chaining them
+    returns a new Color with the shared :class:`Style` of the chain.
+
+    Concatenating colors builds a flat list of spans, appending to a
+    line with ``line + red('a') + 'b'`` is cheap, and the whole line is
+    rendered in one pass.
     """
 
-    def __init__(self, *items):
-        self.items = items
+    __slots__ = ('_spans', '_count', '_style')
 
-        self.styles = []
-        self.fgcolor = None
-        self.bgcolor = None
+    def __init__(self, *items):
+        # spans may be shared with the colors concatenated from this
+        # one, only the first ``_count`` spans belong to this color
+        self._spans = list(items)
+        self._count = len(items)
+        self._style = _plain_style
 
     def __getattr__(self, key):
-        if key.endswith('_bg'):
-            name = key[:-3]
-            if name not in _colors:
-                raise AttributeError("Color has no attribute '%s'" % key)
-            self.bgcolor = _colors.index(name)
-            return self
+        if key.startswith('_'):
+            raise AttributeError("Color has no attribute '%s'" % key)
 
-        if key in _colors:
-            self.fgcolor = _colors.index(key)
-            return self
+        style = self._style.chain(key)
+        c = Color.__new__(Color)
+        c._spans = self._spans
+        c._count = self._count
+        c._style = style
+        return c
 
-        if key in _styles:
-            code = _styles.index(key)
-            self.styles.append(code + 1)
-            return self
-        try:
-            return object.__getattribute__(self, key)
-        except AttributeError:
-            raise AttributeError("Color has no attribute '%s'" % key)
+    @property
+    def items(self):
+        return tuple(self._spans[:self._count])
+
+    @items.setter
+    def items(self, items):
+        self._spans = list(items)
+        self._count = len(items)
+
+    @property
+    def style(self):
+        return self._style
+
+    @style.setter
+    def style(self, style):
+        self._style = style
+
+    @property
+    def fgcolor(self):
+        return self._style[0]
+
+    @fgcolor.setter
+    def fgcolor(self, color):
+        fgcolor, bgcolor, styles = self._style
+        self._style = Style(color, bgcolor, styles)
+
+    @property
+    def bgcolor(self):
+        return self._style[1]
+
+    @bgcolor.setter
+    def bgcolor(self, color):
+        fgcolor, bgcolor, styles = self._style
+        self._style = Style(fgcolor, color, styles)
+
+    @property
+    def styles(self):
+        return self._style[2]
+
+    @styles.setter
+    def styles(self, codes):
+        fgcolor, bgcolor, styles = self._style
+        self._style = Style(fgcolor, bgcolor, codes)
+
+    def _extend(self, items):
+        count = self._count
+        spans = self._spans
+        with _extend_lock:
+            # append in place only if no other color has extended the
+            # shared spans, the check and the append must be atomic
+            if len(spans) == count:
+                spans.extend(items)
+            else:
+                spans = spans[:count]
+                spans.extend(items)
+
+        c = Color()
+        c._spans = spans
+        c._count = count + len(items)
+        return c
+
+    def _render(self, out, depth):
+        prefix, suffix = self._style.wrap(depth)
+        if prefix:
+            out.append(prefix)
+
+        spans = self._spans
+        for i in range(self._count):
+            item = spans[i]
+            if isinstance(item, Color):
+                item._render(out, depth)
+            else:
+                out.append(unicode(item))
+
+        if suffix:
+            out.append(suffix)
+        return out
+
+    def spans(self):
+        """
+        Flatten the color into a list of ``(style, text)`` spans.
+
+        The style is a :class:`Style`, with the styles of the outer
+        colors merged into it. It is the input of :func:`render_spans`.
+        """
+
+        return self._flatten([], _plain_style)
+
+    def _flatten(self, out, style):
+        style = style.merge(self._style)
+        spans = self._spans
+        for i in range(self._count):
+            item = spans[i]
+            if isinstance(item, Color):
+                item._flatten(out, style)
+            else:
+                out.append((style, unicode(item)))
+        return out
+
+    def render_into(self, buf, encoding='utf-8', profile=None):
+        """
+        Render the color in bytes, appending to a buffer.
+
+        It skips the intermediate strings of ``str(color)``, the escape
+        codes are cached in bytes, and only the text is encoded::
+
+            buf = bytearray()
+            for line in lines:
+                line.render_into(buf)
+            os.write(fd, buf)
+
+        :param buf: a ``bytearray`` to append to
+        :param encoding: the encoding of the text
+        :param profile: the :class:`TerminalProfile` to render for
+        """
+
+        if profile is None:
+            profile = get_profile()
+        self._render_into(buf, _render_depth(profile), encoding)
+        return buf
+
+    def _render_into(self, buf, depth, encoding):
+        prefix, suffix = self._style.wrap_bytes(depth)
+        if prefix:
+            buf.extend(prefix)
+
+        spans = self._spans
+        for i in range(self._count):
+            item = spans[i]
+            if isinstance(item, Color):
+                item._render_into(buf, depth, encoding)
+            elif isinstance(item, bytes):
+                buf.extend(item)
+            else:
+                buf.extend(unicode(item).encode(encoding))
+
+        if suffix:
+            buf.extend(suffix)
+
+    def render(self, profile=None, minimal=False):
+        """
+        Render the color into a string.
+
+        The default output wraps each color in its own codes and reset,
+        which is what ``str(color)`` returns. A minimal render emits only
+        the changes between adjacent spans, and one reset at the end::
+
+            line = red('a') + green('b')
+            line.render(minimal=True)
+
+        :param profile: the :class:`TerminalProfile` to render for
+        :param minimal: emit the minimal escape codes
+        """
+
+        if profile is None:
+            profile = get_profile()
+        if minimal:
+            return render_spans(self.spans(), profile)
+        return ''.join(self._render([], _render_depth(profile)))
 
     def __str__(self):
-        text = ''.join(unicode(item) for item in self.items)
+        text = self.render()
 
         if unicode != str:
             text = text.encode('utf-8')
-
-        if not is_color_supported():
-            return text
-
-        is256 = is_256color_supported()
-
-        if self.fgcolor and not isinstance(self.fgcolor, int):
-            self.fgcolor = _color2ansi(self.fgcolor)
-
-        if self.bgcolor and not isinstance(self.bgcolor, int):
-            self.bgcolor = _color2ansi(self.bgcolor)
-
-        if is256:
-            if self.fgcolor is not None:
-                text = '\x1b[38;5;%im%s%s' % (self.fgcolor, text, _reset)
-            if self.bgcolor is not None:
-                text = '\x1b[48;5;%im%s%s' % (self.bgcolor, text, _reset)
-
-        else:
-            if self.fgcolor is not None and self.fgcolor < 8:
-                text = '\x1b[%im%s%s' % (30 + self.fgcolor, text, _reset)
-            if self.bgcolor is not None and self.bgcolor < 8:
-                text = '\x1b[%im%s%s' % (40 + self.bgcolor, text, _reset)
-
-        if self.styles:
-            code = ';'.join(str(i) for i in self.styles)
-            text = '\x1b[%sm%s%s' % (code, text, _reset)
-
         return text
 
     def __repr__(self):
         return repr(str(self))
 
+    def _truncate(self, size):
+        c = Color()
+        c._style = self._style
+        items = c._spans
+        spans = self._spans
+        for i in range(self._count):
+            if size <= 0:
+                break
+            item = spans[i]
+            if isinstance(item, Color):
+                item, size = item._truncate(size)
+            else:
+                item = unicode(item)[:size]
+                size -= len(item)
+            items.append(item)
+        c._count = len(items)
+        return c, size
+
+    def __format__(self, spec):
+        if not spec:
+            return str(self)
+
+        m = _format_spec_re.match(spec)
+        if m is None:
+            # fill with zeros, signs and the like only make sense on the
+            # plain text, format it without the escape codes
+            plain = ''.join(self._render([], 0))
+            return format(plain, spec)
+
+        fill, align, width, precision = m.groups()
+        color = self
+        if precision is not None:
+            color = self._truncate(int(precision))[0]
+        text = str(color)
+        if width is None:
+            return text
+
+        padding = int(width) - visible_width(text)
+        if padding <= 0:
+            return text
+
+        fill = fill or ' '
+        if align == '>':
+            return fill * padding + text
+        if align == '^':
+            left = padding // 2
+            return fill * left + text + fill * (padding - left)
+        return text + fill * padding
+
     def __len__(self):
-        return sum([len(item) for item in self.items])
+        return visible_width(self)
 
     def __add__(self, s):
         if not isinstance(s, (string_type, Color)):
             msg = "Concatenatation failed: %r + %r (Not a ColorString or str)"
             raise TypeError(msg % (type(s), type(self)))
-        return Color(self, s)
+
+        if self._style is not _plain_style:
+            return Color(self, s)
+        if isinstance(s, Color) and s._style is _plain_style:
+            return self._extend(s.items)
+        return self._extend((s,))
 
     def __radd__(self, s):
         if not isinstance(s, (string_type, Color)):
@@ -221,6 +1075,661 @@ class Color(object):
         return Color(s, self)
 
 
+# codes to turn off each style
+_styles_off = {
+    1: '22', 2: '22', 3: '23', 4: '24', 5: '25',
+    6: '55', 7: '27', 8: '28', 9: '29',
+}
+
+
+def _sgr_state(style, depth):
+    # the renderable (fgcolor, bgcolor, styles) codes of a style
+    if not style:
+        return None, None, ()
+
+    fgcolor, bgcolor, styles = style
+    fgcolor = _normalize_color(fgcolor)
+    bgcolor = _normalize_color(bgcolor)
+
+    fg = _color_code(fgcolor, depth)
+    bg = _color_code(bgcolor, depth, True)
+    return fg, bg, tuple(str(code) for code in styles)
+
+
+def _sgr_diff(current, target):
+    cur_fg, cur_bg, cur_styles = current
+    fg, bg, styles = target
+
+    codes = []
+    offs = []
+    for code in cur_styles:
+        if code not in styles:
+            off = _styles_off[int(code)]
+            if off not in offs:
+                offs.append(off)
+    codes.extend(offs)
+
+    for code in styles:
+        # bold and faint are turned off by the same code
+        if code not in cur_styles or _styles_off[int(code)] in offs:
+            codes.append(code)
+
+    if fg != cur_fg:
+        codes.append(fg or '39')
+    if bg != cur_bg:
+        codes.append(bg or '49')
+
+    reset = ['0']
+    reset.extend(styles)
+    if fg:
+        reset.append(fg)
+    if bg:
+        reset.append(bg)
+
+    if len(reset) < len(codes):
+        codes = reset
+    return '\x1b[%sm' % ';'.join(codes)
+
+
+def render_spans(spans, profile=None):
+    """
+    Render ``(style, text)`` spans with the minimal escape codes.
+
+    Instead of resetting after every span, it keeps track of the
+    current state, emits only the changed attributes, and resets once
+    at the end. The style is a ``(fgcolor, bgcolor, styles)`` tuple or
+    None for plain text::
+
+        render_spans([
+            (('red', None, (1,)), 'error'),
+            ((None, None, (1,)), ': '),
+            (None, 'file not found'),
+        ])
+
+    :param spans: an iterable of ``(style, text)``
+    :param profile: the :class:`TerminalProfile` to render for
+    """
+
+    if profile is None:
+        profile = get_profile()
+    depth = _render_depth(profile)
+    if not depth:
+        return ''.join(text for style, text in spans)
+
+    default = (None, None, ())
+    current = default
+    states = {}
+    out = []
+    for style, text in spans:
+        if not text:
+            continue
+        target = states.get(style)
+        if target is None:
+            target = states[style] = _sgr_state(style, depth)
+        if target != current:
+            out.append(_sgr_diff(current, target))
+            current = target
+        out.append(text)
+
+    if current != default:
+        out.append(_reset)
+    return ''.join(out)
+
+
+# CSI sequences, OSC sequences and two characters escapes
+_ansi_re = re.compile(
+    r'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[@-Z\\-_])'
+)
+_not_printable_ascii_re = re.compile(r'[^\x20-\x7e]')
+
+# East Asian wide and fullwidth characters
+_wide_ranges = (
+    (0x1100, 0x115f), (0x231a, 0x231b), (0x2329, 0x232a),
+    (0x23e9, 0x23ec), (0x23f0, 0x23f0), (0x23f3, 0x23f3),
+    (0x25fd, 0x25fe), (0x2614, 0x2615), (0x2648, 0x2653),
+    (0x267f, 0x267f), (0x2693, 0x2693), (0x26a1, 0x26a1),
+    (0x26aa, 0x26ab), (0x26bd, 0x26be), (0x26c4, 0x26c5),
+    (0x26ce, 0x26ce), (0x26d4, 0x26d4), (0x26ea, 0x26ea),
+    (0x26f2, 0x26f3), (0x26f5, 0x26f5), (0x26fa, 0x26fa),
+    (0x26fd, 0x26fd), (0x2705, 0x2705), (0x270a, 0x270b),
+    (0x2728, 0x2728), (0x274c, 0x274c), (0x274e, 0x274e),
+    (0x2753, 0x2755), (0x2757, 0x2757), (0x2795, 0x2797),
+    (0x27b0, 0x27b0), (0x27bf, 0x27bf), (0x2b1b, 0x2b1c),
+    (0x2b50, 0x2b50), (0x2b55, 0x2b55), (0x2e80, 0x303e),
+    (0x3041, 0x33ff), (0x3400, 0x4dbf), (0x4e00, 0x9fff),
+    (0xa000, 0xa4cf), (0xa960, 0xa97f), (0xac00, 0xd7a3),
+    (0xf900, 0xfaff), (0xfe10, 0xfe19), (0xfe30, 0xfe6f),
+    (0xff00, 0xff60), (0xffe0, 0xffe6), (0x16fe0, 0x16fe4),
+    (0x17000, 0x18cff), (0x1b000, 0x1b2ff), (0x1f004, 0x1f004),
+    (0x1f0cf, 0x1f0cf), (0x1f18e, 0x1f18e), (0x1f191, 0x1f19a),
+    (0x1f200, 0x1f202), (0x1f210, 0x1f23b), (0x1f240, 0x1f248),
+    (0x1f250, 0x1f251), (0x1f260, 0x1f265), (0x1f300, 0x1f64f),
+    (0x1f680, 0x1f6ff), (0x1f7e0, 0x1f7eb), (0x1f90c, 0x1f9ff),
+    (0x1fa70, 0x1faff), (0x20000, 0x2fffd), (0x30000, 0x3fffd),
+)
+_wide_starts = [start for start, end in _wide_ranges]
+_char_widths = {}
+
+
+def _char_width(char):
+    width = _char_widths.get(char)
+    if width is not None:
+        return width
+
+    code = ord(char)
+    if code < 0x20 or 0x7f <= code < 0xa0:
+        width = 0
+    elif code == 0xad:
+        # soft hyphen
+        width = 1
+    elif unicodedata.combining(char) or \
+            unicodedata.category(char) in ('Mn', 'Me', 'Cf'):
+        width = 0
+    else:
+        i = bisect_right(_wide_starts, code) - 1
+        if i >= 0 and code <= _wide_ranges[i][1]:
+            width = 2
+        else:
+            width = 1
+
+    _char_widths[char] = width
+    return width
+
+
+def strip_ansi(text):
+    """
+    Remove the ANSI escape sequences from a string.
+
+    :param text: the string to strip
+    """
+
+    if '\x1b' not in text:
+        return text
+    return _ansi_re.sub('', text)
+
+
+def _lru_cache(maxsize):
+    try:
+        from functools import lru_cache
+        return lru_cache(maxsize)
+    except ImportError:  # pragma: no cover
+        pass
+
+    def decorator(func):
+        cache = {}
+
+        def wrapper(arg):
+            try:
+                return cache[arg]
+            except KeyError:
+                pass
+            if len(cache) >= maxsize:
+                cache.clear()
+            rv = cache[arg] = func(arg)
+            return rv
+        return wrapper
+    return decorator
+
+
+@_lru_cache(4096)
+def _text_width(text):
+    text = strip_ansi(text)
+    if not _not_printable_ascii_re.search(text):
+        return len(text)
+    return sum(_char_width(char) for char in text)
+
+
+def visible_width(text):
+    """
+    Get the width of a string as it is displayed on the terminal.
+
+    The ANSI escape sequences are not counted, East Asian wide
+    characters count as two columns, and combining marks count as
+    zero::
+
+        assert visible_width(u'\\u4e2d\\u6587') == 4
+        assert visible_width(str(red('text'))) == 4
+
+    :param text: a string or a :class:`Color`
+    """
+
+    if isinstance(text, Color):
+        return sum(_text_width(span) for style, span in text.spans())
+    if isinstance(text, bytes) and unicode != bytes:
+        text = text.decode('utf-8', 'replace')
+    elif not isinstance(text, string_type):
+        text = unicode(text)
+    return _text_width(text)
+
+
+# the max number of buffers for one writev call, POSIX requires >= 16
+_iov_max = 1024
+
+
+def write_buffers(fd, buffers):
+    """
+    Write buffers to a raw file descriptor.
+
+    It uses a single ``os.writev`` call when possible, and takes care
+    of partial writes.
+
+    :param fd: the file descriptor
+    :param buffers: a list of bytes or bytearray
+    """
+
+    views = [memoryview(buf) for buf in buffers if len(buf)]
+    writev = getattr(os, 'writev', None)
+    while views:
+        if writev is not None:
+            written = writev(fd, views[:_iov_max])
+        else:  # pragma: no cover
+            written = os.write(fd, views[0])
+
+        while written:
+            size = len(views[0])
+            if written < size:
+                views[0] = views[0][written:]
+                break
+            written -= size
+            views.pop(0)
+
+
+class ByteWriter(object):
+    """
+    Buffer colors in bytes and flush them to a raw file descriptor.
+
+    For high-volume output, the colors are rendered with
+    :meth:`Color.render_into` to a buffer, which is flushed with one
+    system call when it is full::
+
+        writer = ByteWriter()
+        for row in rows:
+            writer.write(red(row.key) + ' ' + row.value + '\\n')
+        writer.flush()
+
+    :param stream: the output stream or file descriptor, default is
+                   ``sys.stdout``
+    :param encoding: the encoding of the text, default is the encoding
+                     of the terminal profile
+    :param profile: the :class:`TerminalProfile` to render for
+    :param buffer_size: flush the buffer when it exceeds this size
+    """
+
+    def __init__(self, stream=None, encoding=None, profile=None,
+                 buffer_size=65536):
+        if stream is None:
+            stream = sys.stdout
+
+        if isinstance(stream, int):
+            self.stream = None
+            self.fd = stream
+        else:
+            self.stream = stream
+            self.fd = stream.fileno()
+
+        if profile is None:
+            profile = get_profile(self.stream)
+        self.profile = profile
+        self.encoding = encoding or profile.encoding
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+
+    def write(self, text):
+        """
+        Render a color or text into the buffer.
+
+        :param text: a :class:`Color`, a string or bytes
+        """
+
+        if isinstance(text, (Color, PlainText)):
+            text.render_into(self.buffer, self.encoding, self.profile)
+        elif isinstance(text, bytes):
+            self.buffer.extend(text)
+        else:
+            self.buffer.extend(unicode(text).encode(self.encoding))
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return self
+
+    def flush(self):
+        """
+        Write the buffer to the file descriptor.
+        """
+
+        if self.stream is not None:
+            # keep the order with the data buffered in the stream
+            self.stream.flush()
+        write_buffers(self.fd, [self.buffer])
+        del self.buffer[:]
+        return self
+
+
+_formatter = string.Formatter()
+_templates = {}
+
+
+def _parse_style(spec):
+    # 'bold.red' or 'bold.red:>10' to (style, '>10'), or None
+    names, _, format_spec = spec.partition(':')
+    style = _plain_style
+    for name in names.split('.'):
+        try:
+            style = style.chain(name)
+        except AttributeError:
+            return None, spec
+    return style, format_spec
+
+
+class Template(object):
+    """
+    A compiled color template, use :func:`compile` to create it.
+
+    The template is parsed once, and the escape codes of the styled
+    fields are rendered in advance, formatting only fills in the
+    values.
+
+    :param source: the template string
+    :param profile: the :class:`TerminalProfile` to render for
+    """
+
+    def __init__(self, source, profile=None):
+        if profile is None:
+            profile = get_profile()
+        self.source = source
+        self.profile = profile
+
+        depth = _render_depth(profile)
+        parts = []
+        for literal, field, spec, conversion in _formatter.parse(source):
+            parts.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is None:
+                continue
+
+            style = None
+            if spec:
+                style, spec = _parse_style(spec)
+
+            field = '{%s%s%s}' % (
+                field,
+                conversion and '!' + conversion or '',
+                spec and ':' + spec or '',
+            )
+            if style is None:
+                parts.append(field)
+            else:
+                prefix, suffix = style.wrap(depth)
+                parts.extend((prefix, field, suffix))
+
+        self.compiled = ''.join(parts)
+
+    def __repr__(self):
+        return '<Template %r>' % self.source
+
+    def format(self, *args, **kwargs):
+        """
+        Format the template with the values.
+        """
+
+        return self.compiled.format(*args, **kwargs)
+
+    __call__ = format
+
+
+def compile(source, profile=None):
+    """
+    Compile a color template for formatting the same shape of line
+    many times.
+
+    The template has the syntax of :meth:`str.format`, the format spec
+    of a field can be a chain of colors and styles, followed by the
+    standard format spec::
+
+        from terminal.color import compile
+
+        line = compile('{level:bold.red} {key:cyan:<10}={value}')
+        print(line(level='error', key='path', value='/tmp'))
+
+    The compiled templates are cached.
+
+    :param source: the template string
+    :param profile: the :class:`TerminalProfile` to render for
+    """
+
+    if profile is None:
+        profile = get_profile()
+    key = (source, _render_depth(profile))
+    template = _templates.get(key)
+    if template is None:
+        template = _templates[key] = Template(source, profile)
+    return template
+
+
+# the upper half block, u'' literals are a syntax error on Python 3.2
+_half_block = b'\xe2\x96\x80'.decode('utf-8')
+_downsample8 = [quantize(*rgb, colors=8) for rgb in _palette]
+
+
+def _image_keys(pixels, depth):
+    # color keys of each pixel: packed RGB for truecolor, ansi otherwise
+    numpy = _get_numpy()
+    if numpy is not None:
+        arr = numpy.clip(numpy.asarray(pixels), 0, 255).astype(numpy.intp)
+        if depth >= TerminalProfile.TRUECOLOR:
+            return (arr[..., 0] << 16) | (arr[..., 1] << 8) | arr[..., 2]
+        keys = rgb2ansi_array(arr)
+        if depth < TerminalProfile.ANSI256:
+            keys = numpy.array(_downsample8)[keys]
+        return keys
+
+    rows = []
+    for row in pixels:
+        keys = []
+        for r, g, b in row:
+            r, g, b = (min(max(int(val), 0), 255) for val in (r, g, b))
+            if depth >= TerminalProfile.TRUECOLOR:
+                keys.append((r << 16) | (g << 8) | b)
+            elif depth >= TerminalProfile.ANSI256:
+                keys.append(_rgb2ansi_lut(r, g, b))
+            else:
+                keys.append(_downsample8[_rgb2ansi_lut(r, g, b)])
+        rows.append(keys)
+    return rows
+
+
+def _image_codes(keys, depth, background):
+    # SGR parameters of color keys, a negative key is the default color
+    if depth >= TerminalProfile.TRUECOLOR:
+        fmt = background and '48;2;%i;%i;%i' or '38;2;%i;%i;%i'
+        return [
+            key < 0 and '49' or fmt % (key >> 16, key >> 8 & 0xff, key & 0xff)
+            for key in keys
+        ]
+
+    table = _image_tables.get((depth, background))
+    if table is None:
+        table = dict(
+            (key, _color_code(key, depth, background)) for key in range(256)
+        )
+        table[-1] = '49'
+        _image_tables[(depth, background)] = table
+    return [table[key] for key in keys]
+
+
+_image_tables = {}
+_image_arrays = {}
+
+
+def _image_code_columns(keys, depth, background):
+    # SGR parameters of a NumPy array of color keys, split in columns of
+    # strings to be joined without building the strings of each code
+    numpy = _get_numpy()
+    if depth >= TerminalProfile.TRUECOLOR:
+        table = _image_arrays.get('bytes')
+        if table is None:
+            table = numpy.array([str(i) for i in range(256)], object)
+            _image_arrays['bytes'] = table
+        default = keys < 0
+        if not default.any():
+            return [
+                background and '48;2;' or '38;2;', table[keys >> 16],
+                ';', table[keys >> 8 & 0xff], ';', table[keys & 0xff],
+            ]
+
+        columns = [numpy.where(default, '49', background and '48;2;' or
+                               '38;2;').astype(object)]
+        for shift in (16, 8, 0):
+            if shift < 16:
+                columns.append(numpy.where(default, '', ';').astype(object))
+            columns.append(table[keys >> shift & 0xff])
+            columns[-1][default] = ''
+        return columns
+
+    table = _image_arrays.get((depth, background))
+    if table is None:
+        # the default color is the last item, a key of -1 indexes it
+        table = [_color_code(key, depth, background) for key in range(256)]
+        table = numpy.array(table + ['49'], object)
+        _image_arrays[(depth, background)] = table
+    return [table[keys]]
+
+
+def _image_lines(keys, depth):
+    # render all lines of cells in one pass of NumPy
+    numpy = _get_numpy()
+    height, width = keys.shape
+    if height % 2:
+        keys = numpy.concatenate((keys, numpy.full((1, width), -1, int)))
+    top = keys[0::2]
+    bottom = keys[1::2]
+
+    # split the lines into runs of cells in the same colors
+    starts = numpy.ones(top.shape, bool)
+    starts[:, 1:] = (top[:, 1:] != top[:, :-1]) | (
+        bottom[:, 1:] != bottom[:, :-1])
+    rows, cols = numpy.nonzero(starts)
+    tops = top[rows, cols]
+    bottoms = bottom[rows, cols]
+    ends = numpy.empty_like(cols)
+    ends[:-1] = numpy.where(cols[1:] == 0, width, cols[1:])
+    ends[-1] = width
+
+    # a run differs from the previous one in a color at least, emit
+    # only the codes of what changed, and both at the start of a line
+    first = cols == 0
+    fg_changed = first.copy()
+    fg_changed[1:] |= tops[1:] != tops[:-1]
+    bg_changed = first.copy()
+    bg_changed[1:] |= bottoms[1:] != bottoms[:-1]
+
+    blocks = [_half_block * size for size in range(width + 1)]
+    fg_columns = _image_code_columns(tops, depth, False)
+    columns = (
+        ['\x1b['] + fg_columns + [';'] +
+        _image_code_columns(bottoms, depth, True) +
+        ['m', numpy.array(blocks, object)[ends - cols]]
+    )
+    parts = numpy.empty((len(cols), len(columns)), object)
+    for i, column in enumerate(columns):
+        parts[:, i] = column
+
+    # blank the codes of the colors kept from the previous run, the
+    # separator is blanked with either of them
+    sep = len(fg_columns) + 1
+    parts[~fg_changed, 1:sep + 1] = ''
+    parts[~bg_changed, sep:-2] = ''
+
+    offset = 0
+    for count in numpy.bincount(rows, minlength=len(top)).tolist():
+        line = parts[offset:offset + count].ravel().tolist()
+        yield ''.join(line) + _reset
+        offset += count
+
+
+def iter_image(pixels, profile=None):
+    """
+    Render an image in the terminal, yielding it line by line.
+
+    Each character cell paints two pixel rows with the upper half block,
+    the upper pixel in the foreground color and the lower pixel in the
+    background color. Adjacent cells in the same colors share their
+    escape codes. With NumPy, the colors are converted in one pass::
+
+        for line in iter_image(numpy.zeros((100, 200, 3), 'uint8')):
+            print(line)
+
+    :param pixels: RGB pixels in the shape of ``(height, width, 3)``,
+                   a NumPy array or nested lists
+    :param profile: the :class:`TerminalProfile` to render for
+    """
+
+    if profile is None:
+        profile = get_profile()
+    depth = _render_depth(profile)
+
+    width = len(pixels) and len(pixels[0])
+    if not depth or not width:
+        for i in range(0, len(pixels), 2):
+            yield ' ' * width
+        return
+
+    keys = _image_keys(pixels, depth)
+    if _get_numpy() is not None:
+        for line in _image_lines(keys, depth):
+            yield line
+        return
+
+    for y in range(0, len(keys), 2):
+        top = keys[y]
+        if y + 1 < len(keys):
+            bottom = keys[y + 1]
+        else:
+            bottom = [-1] * width
+
+        # split the line into runs of cells in the same colors
+        starts = [0] + [
+            x for x in range(1, width)
+            if top[x] != top[x - 1] or bottom[x] != bottom[x - 1]
+        ]
+        tops = [top[x] for x in starts]
+        bottoms = [bottom[x] for x in starts]
+        ends = starts[1:] + [width]
+
+        parts = []
+        fg = bg = None
+        runs = zip(
+            tops, bottoms,
+            _image_codes(tops, depth, False),
+            _image_codes(bottoms, depth, True),
+            starts, ends,
+        )
+        for top, bottom, fg_code, bg_code, start, end in runs:
+            if top != fg and bottom != bg:
+                parts.append('\x1b[%s;%sm' % (fg_code, bg_code))
+            elif top != fg:
+                parts.append('\x1b[%sm' % fg_code)
+            else:
+                parts.append('\x1b[%sm' % bg_code)
+            fg = top
+            bg = bottom
+            parts.append(_half_block * (end - start))
+
+        parts.append(_reset)
+        yield ''.join(parts)
+
+
+def render_image(pixels, profile=None):
+    """
+    Render an image in the terminal, returning a list of lines.
+    See :func:`iter_image`.
+
+    :param pixels: RGB pixels in the shape of ``(height, width, 3)``
+    :param profile: the :class:`TerminalProfile` to render for
+    """
+
+    return list(iter_image(pixels, profile))
+
+
 def colorize(text, color, background=False):
     """
     Colorize text with hex code.
@@ -238,23 +1747,118 @@ def colorize(text, color, background=False):
     """
 
     if color in _styles:
-        c = Color(text)
-        c.styles = [_styles.index(color) + 1]
-        return c
+        style = Style(styles=(_styles.index(color) + 1,))
+    elif background:
+        style = Style(bgcolor=_normalize_color(color))
+    else:
+        style = Style(fgcolor=_normalize_color(color))
+
+    if _is_plain_mode():
+        return _plain_text(text)
 
     c = Color(text)
-    if background:
-        c.bgcolor = _color2ansi(color)
-    else:
-        c.fgcolor = _color2ansi(color)
+    c._style = style
     return c
 
 
+class PlainText(str):
+    """
+    Text painted when colors are disabled.
+
+    The color functions like :func:`red` return it instead of a
+    :class:`Color` when the output has no color support. It is a
+    ``str``, but it keeps the methods of :class:`Color` working, the
+    colors and styles are simply ignored::
+
+        set_color_mode('never')
+        assert red('text').bold == 'text'
+    """
+
+    __slots__ = ()
+
+    def __getattr__(self, key):
+        if key in _colors or key in _styles:
+            return self
+        if key.endswith('_bg') and key[:-3] in _colors:
+            return self
+        raise AttributeError("PlainText has no attribute '%s'" % key)
+
+    @property
+    def items(self):
+        return (str(self),)
+
+    @property
+    def style(self):
+        return _plain_style
+
+    fgcolor = bgcolor = None
+    styles = ()
+
+    def spans(self):
+        return [(_plain_style, unicode(self))]
+
+    def render(self, profile=None, minimal=False):
+        return unicode(self)
+
+    def render_into(self, buf, encoding='utf-8', profile=None):
+        if isinstance(self, bytes):
+            buf.extend(self)
+        else:
+            buf.extend(self.encode(encoding))
+        return buf
+
+
+_color_modes = ('auto', 'always', 'never')
+_color_mode = 'auto'
+
+
+def set_color_mode(mode):
+    """
+    Decide when the color functions paint text.
+
+    In ``auto`` mode, the color functions like :func:`red` return a
+    plain :class:`PlainText` when the terminal has no color support,
+    which is much cheaper than a :class:`Color`. ``always`` returns a
+    :class:`Color` anyway, and ``never`` returns plain text anyway,
+    and renders the existing colors and templates without escape codes.
+
+    :param mode: one of ``auto``, ``always`` and ``never``
+    """
+
+    global _color_mode
+    if mode not in _color_modes:
+        raise ValueError('invalid color mode: %s' % mode)
+    _color_mode = mode
+
+
+def _plain_text(text):
+    if text.__class__ is PlainText:
+        return text
+    if isinstance(text, Color):
+        text = ''.join(text._render([], 0))
+    if unicode != str and isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return PlainText(text)
+
+
+def _is_plain_mode():
+    mode = _color_mode
+    return mode == 'never' or (mode == 'auto' and not get_profile().depth)
+
+
+def _render_depth(profile):
+    # the never mode renders without escape codes for any profile
+    if _color_mode == 'never':
+        return 0
+    return profile.depth
+
+
 def _create_color_func(text, fgcolor=None, bgcolor=None, *styles):
+    if _is_plain_mode():
+        return _plain_text(text)
+
     c = Color(text)
-    c.fgcolor = fgcolor
-    c.bgcolor = bgcolor
-    c.styles = styles
+    c._style = Style(fgcolor, bgcolor, styles)
     return c
 
 
@@ -381,7 +1985,7 @@ def gray(text):
     """
     Gray color.
     """
-    if is_256color_supported():
+    if get_profile().depth >= TerminalProfile.ANSI256:
         return _create_color_func(text, fgcolor=8)
     return _create_color_func(text, 0, None, 8)
 
@@ -453,7 +2057,7 @@ def gray_bg(text):
     """
     Gray background.
     """
-    if is_256color_supported():
+    if get_profile().depth >= TerminalProfile.ANSI256:
         return _create_color_func(text, bgcolor=8)
     return _create_color_func(text, None, 0, 1)
 
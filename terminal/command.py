@@ -11,6 +11,7 @@
 import re
 import sys
 import inspect
+from .color import visible_width
 
 
 class Option(object):
@@ -591,7 +592,7 @@ class Command(object):
             pos = ' '.join(['<%s>' % name for name in self._positional_list])
             print('\n  %s %s' % (usage, pos))
 
-        arglen = max(len(o.name) for o in self._option_list)
+        arglen = max(visible_width(o.name) for o in self._option_list)
         arglen += 2
 
         self.print_title('\n  Options:\n')
@@ -617,4 +618,4 @@ class Command(object):
 
 
 def _pad(msg, length):
-    return '%s%s' % (msg, ' ' * (length - len(msg)))
+    return '%s%s' % (msg, ' ' * (length - visible_width(msg)))
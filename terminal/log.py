@@ -8,8 +8,506 @@
     :copyright: (c) 2013 by Hsiaoming Yang.
 """
 
+import re
 import sys
-import copy
+import json
+import math
+import time
+import atexit
+import random
+import weakref
+import itertools
+import threading
+import collections
+from types import FunctionType
+from .color import ContextVar, _LocalVar, strip_ansi
+from .sink import ConsoleSink, BufferedSink, StreamSink, QueueSink, LEVELS
+from .sink import WeakSet
+
+if sys.version_info[0] == 3:
+    string_type = str
+    integer_types = (int,)
+
+    def _next_method(counter):
+        return counter.__next__
+else:
+    string_type = (unicode, str)  # noqa
+    integer_types = (int, long)  # noqa
+
+    def _next_method(counter):
+        return counter.next
+
+
+# a monotonic clock
+_clock = getattr(time, 'perf_counter', time.time)
+
+# the frames of this module are skipped to find the call site of a log
+_this_file = __file__.rstrip('co')
+
+
+class lazy(object):
+    """
+    Mark a function to be called only when the log is shown::
+
+        log.debug('summary: %s', lazy(expensive_summary, data))
+
+    Zero-argument lambdas are lazy too. Other callables, like functions
+    and bound methods, are logged as they are.
+
+    :param func: the function to call
+    :param args: the arguments of the function
+    :param kwargs: the keyword arguments of the function
+    """
+
+    __slots__ = ('func', 'args', 'kwargs')
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+    def __str__(self):
+        return str(self())
+
+
+def _evaluate(o):
+    # call the lazy arguments, lazy wrappers and zero-argument lambdas
+    cls = o.__class__
+    if cls is lazy:
+        return o()
+    if cls is FunctionType and o.__name__ == '<lambda>' and \
+            not o.__code__.co_argcount:
+        return o()
+    return o
+
+
+def format_args(args):
+    """
+    Format the arguments of a log into a message.
+
+    The arguments are evaluated lazily, it is called only when the log
+    is going to be shown. A :class:`lazy` argument or a zero-argument
+    lambda is called to get its value, and a ``%``-style format string
+    is formatted with the rest of the arguments::
+
+        log.debug('%s items in %r', len(items), data)
+        log.debug(lambda: expensive_summary(data))
+
+    Otherwise, the arguments are joined with spaces.
+    """
+
+    if len(args) == 1 and type(args[0]) is str:
+        return args[0]
+
+    args = [_evaluate(o) for o in args]
+    if len(args) > 1 and isinstance(args[0], string_type) and '%' in args[0]:
+        values = args[1:]
+        if len(values) == 1 and isinstance(values[0], dict):
+            values = values[0]
+        else:
+            values = tuple(values)
+        try:
+            return args[0] % values
+        except (TypeError, ValueError, KeyError):
+            pass
+    return ' '.join((str(o) for o in args))
+
+
+_json_escape_re = re.compile(r'[\x00-\x1f\\"]')
+_json_escapes = {
+    '\\': '\\\\',
+    '"': '\\"',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\t': '\\t',
+    '\b': '\\b',
+    '\f': '\\f',
+}
+
+
+def _json_escape(m):
+    char = m.group(0)
+    try:
+        return _json_escapes[char]
+    except KeyError:
+        return '\\u%04x' % ord(char)
+
+
+def _json_string(value):
+    return '"%s"' % _json_escape_re.sub(_json_escape, value)
+
+
+def _json_float(value):
+    if math.isnan(value) or math.isinf(value):
+        return 'null'
+    return repr(value)
+
+
+_json_types = {
+    str: _json_string,
+    int: str,
+    float: _json_float,
+    bool: lambda value: value and 'true' or 'false',
+    type(None): lambda value: 'null',
+}
+
+
+def _json_value(value):
+    encode = _json_types.get(type(value))
+    if encode is not None:
+        return encode(value)
+    if isinstance(value, string_type):
+        return _json_string(value)
+    if isinstance(value, bool):
+        return value and 'true' or 'false'
+    if isinstance(value, integer_types):
+        return str(int(value))
+    if isinstance(value, float):
+        return _json_float(float(value))
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value, default=str)
+    return _json_string(str(value))
+
+
+def _json_fields(fields):
+    return ''.join([
+        ',%s:%s' % (_json_string(str(key)), _json_value(value))
+        for key, value in fields.items()
+    ])
+
+
+def format_json(level, message, indent=0, timestamp=None, extra=None):
+    """
+    Format a log record into a JSON line, the fields are ``ts``,
+    ``level``, ``msg``, ``indent`` and the extra key/values::
+
+        >>> format_json('info', 'hello', timestamp=0, extra={'a': 1})
+        '{"ts":0.000000,"level":"info","msg":"hello","indent":0,"a":1}\\n'
+
+    :param level: the log level
+    :param message: the log message, colors are removed
+    :param indent: the indent level
+    :param timestamp: the time of the log, default is now
+    :param extra: a dict of extra key/values, or a string of encoded
+                  fields starting with a comma
+    """
+
+    if timestamp is None:
+        timestamp = time.time()
+    if '\x1b' in message:
+        message = strip_ansi(message)
+    if not extra:
+        extra = ''
+    elif isinstance(extra, dict):
+        extra = _json_fields(extra)
+    return '{"ts":%.6f,"level":"%s","msg":%s,"indent":%d%s}\n' % (
+        timestamp, level, _json_string(message), indent, extra,
+    )
+
+
+def _format_elapsed(seconds):
+    if seconds < 0.001:
+        return '%.0fus' % (seconds * 1e6)
+    if seconds < 1:
+        return '%.1fms' % (seconds * 1e3)
+    return '%.2fs' % seconds
+
+
+class _Span(object):
+    """The aggregated timing of a label in the span tree."""
+
+    __slots__ = ('label', 'count', 'total', 'max', 'children')
+
+    def __init__(self, label):
+        self.label = label
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.children = {}
+
+    def child(self, label):
+        node = self.children.get(label)
+        if node is None:
+            node = self.children.setdefault(label, _Span(label))
+        return node
+
+    def to_dict(self):
+        return {
+            'label': self.label,
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'children': [
+                node.to_dict() for node in
+                sorted(self.children.values(), key=lambda n: -n.total)
+            ],
+        }
+
+    def lines(self, depth, scale, width):
+        yield '%-*s %9s %6.1f%%  %-*s x%d, max %s' % (
+            width, '  ' * depth + self.label,
+            _format_elapsed(self.total), self.total * 100 * scale,
+            20, '#' * int(round(self.total * 20 * scale)),
+            self.count, _format_elapsed(self.max),
+        )
+        nodes = sorted(self.children.values(), key=lambda n: -n.total)
+        for node in nodes:
+            for line in node.lines(depth + 1, scale, width):
+                yield line
+
+    def width(self, depth):
+        widths = [node.width(depth + 1) for node in self.children.values()]
+        widths.append(len(self.label) + depth * 2)
+        return max(widths)
+
+
+_formatters = ('human', 'json', 'record')
+
+
+class _TokenBucket(object):
+    """Allow ``rate`` logs per second, with bursts up to ``burst``."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'dropped')
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.updated = _clock()
+        #: the number of logs dropped since the last allowed one
+        self.dropped = 0
+
+    def take(self, now):
+        tokens = self.tokens + (now - self.updated) * self.rate
+        self.tokens = min(tokens, self.burst)
+        self.updated = now
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+class _Backlog(object):
+    """
+    A ring buffer of the suppressed logs. The records are kept with
+    their raw arguments in preallocated slots, and formatted only when
+    they are dumped.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.slots = [None] * size
+        self.dumped = False
+        self._counter = itertools.count()
+        self._count = 0
+
+    def append(self, record):
+        index = next(self._counter)
+        self.slots[index % self.size] = record
+        self._count = index + 1
+
+    def drain(self):
+        count = self._count
+        records = [
+            self.slots[index % self.size]
+            for index in range(max(0, count - self.size), count)
+        ]
+        self.slots = [None] * self.size
+        self._counter = itertools.count()
+        self._count = 0
+        return [record for record in records if record is not None]
+
+
+class _OrderedDict(dict):
+    # the subset of collections.OrderedDict used by dedupe, which is new
+    # in Python 2.7
+
+    def __init__(self):
+        dict.__init__(self)
+        self._keys = []
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._keys.append(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._keys.remove(key)
+
+    def popitem(self, last=True):
+        key = self._keys.pop(last and -1 or 0)
+        return key, dict.pop(self, key)
+
+    def values(self):
+        return [self[key] for key in self._keys]
+
+    def clear(self):
+        dict.clear(self)
+        del self._keys[:]
+
+
+OrderedDict = getattr(collections, 'OrderedDict', _OrderedDict)
+
+
+def _count_value(counter):
+    # the next value of an itertools.count, without increasing it
+    return int(repr(counter)[6:-1])
+
+
+class _Counters(object):
+    """
+    The counters of a logger, 0 and 1 are the warn and error counters,
+    the stats are keyed by tuples like ``('records', 'info')``.
+    """
+
+    def __init__(self, values=None):
+        self._values = dict(values or ())
+
+    def add(self, key, count=1):
+        values = self._values
+        values[key] = values.get(key, 0) + count
+
+    def get(self, key):
+        return self._values.get(key, 0)
+
+    def set(self, key, value):
+        self._values[key] = value
+
+    def items(self):
+        return dict(self._values)
+
+
+class _CellOwner(object):
+    # kept in a thread local, it is released when the thread ends
+    __slots__ = ('__weakref__',)
+
+
+class _ThreadCounters(object):
+    """
+    The counters of a concurrent logger. Each thread increases its own
+    cell, the cells are summed on read, so the threads never wait for
+    each other on counting. The cell of a thread is folded into the base
+    counters when the thread ends.
+    """
+
+    def __init__(self, values=None):
+        self._base = dict(values or ())
+        self._cells = {}
+        self._local = threading.local()
+        self._lock = threading.RLock()
+
+    def _new_cell(self):
+        cell = self._local.cell = {}
+        owner = self._local.owner = _CellOwner()
+        with self._lock:
+            self._cells[weakref.ref(owner, self._fold)] = cell
+        return cell
+
+    def _fold(self, ref):
+        with self._lock:
+            cell = self._cells.pop(ref, None)
+            if not cell:
+                return
+            base = self._base
+            for key, count in list(cell.items()):
+                base[key] = base.get(key, 0) + count
+
+    def add(self, key, count=1):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._new_cell()
+        cell[key] = cell.get(key, 0) + count
+
+    def get(self, key):
+        with self._lock:
+            return self._base.get(key, 0) + sum(
+                cell.get(key, 0) for cell in list(self._cells.values()))
+
+    def set(self, key, value):
+        with self._lock:
+            for cell in list(self._cells.values()):
+                cell.pop(key, None)
+            self._base[key] = value
+
+    def items(self):
+        with self._lock:
+            values = dict(self._base)
+            for cell in list(self._cells.values()):
+                for key, count in list(cell.items()):
+                    values[key] = values.get(key, 0) + count
+        return values
+
+
+if hasattr(str, 'isascii'):
+    def _byte_size(text):
+        # the size of a log in UTF-8, ASCII text is not encoded
+        if text.isascii():
+            return len(text)
+        return len(text.encode('utf-8'))
+else:  # pragma: no cover
+    def _byte_size(text):
+        if isinstance(text, bytes):
+            return len(text)
+        return len(text.encode('utf-8'))
+
+
+def _stream_name(sink):
+    # the name of the stream in stats, None for stdout and stderr
+    stream = getattr(sink, 'stream', None)
+    if stream is not None:
+        return str(getattr(stream, 'name', type(stream).__name__))
+    path = getattr(sink, 'path', None)
+    if path is not None:
+        return path
+    if isinstance(sink, (ConsoleSink, BufferedSink)):
+        return None
+    return type(sink).__name__
+
+
+def _format_prometheus(stats, prefix):
+    lines = []
+
+    def add(name, help, values, label=None):
+        name = '%s_%s' % (prefix, name)
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s counter' % name)
+        if label is None:
+            lines.append('%s %s' % (name, values))
+            return
+        for key in sorted(values):
+            value = str(key).replace('\\', '\\\\').replace('"', '\\"')
+            lines.append('%s{%s="%s"} %s' % (name, label, value, values[key]))
+
+    add('records_total', 'Logs written.', stats['records'], 'level')
+    add('suppressed_total', 'Logs suppressed.', stats['suppressed'], 'level')
+    add('written_bytes_total', 'Size of logs written.', stats['bytes'],
+        'stream')
+    add('warnings_total', 'Warn logs.', stats['warn_count'])
+    add('errors_total', 'Error logs.', stats['error_count'])
+    add('format_seconds_total', 'Estimated time formatting logs.',
+        repr(stats['format_seconds']))
+    add('io_seconds_total', 'Estimated time writing logs.',
+        repr(stats['io_seconds']))
+    add('timing_samples_total', 'Logs sampled for timing.',
+        stats['samples'])
+    return '\n'.join(lines) + '\n'
+
+
+_dedupe_loggers = WeakSet()
+
+
+def _flush_dedupe_loggers():
+    for log in list(_dedupe_loggers):
+        log.flush_repeats()
+
+
+atexit.register(_flush_dedupe_loggers)
 
 
 class Logger(object):
@@ -19,6 +517,26 @@ class Logger(object):
     :param verbose: control if the log to show verbose log
     :param quiet: control if the log to show debug and info log
     :param indent: control the indent level, default is zero
+    :param concurrent: make it safe to log in many threads or asyncio
+                       tasks, default is False
+    :param json: write the logs as JSON lines, True for the sink, or
+                 a stream to write JSON lines besides the sink
+    :param extra: the extra key/values of every JSON log
+    :param level: the lowest level of logs to emit to the sink
+    :param timing: time the nested logs of :meth:`start` and :meth:`end`
+    :param dedupe: hide the same logs repeated in this number of seconds
+    :param dedupe_size: the number of recent logs to remember, default
+                        is 256
+    :param rate_limit: a dict of the max logs per second of each level,
+                       the value can be a tuple of ``(rate, burst)``
+    :param backlog: keep this number of the hidden logs, and show them
+                    on the first error log
+    :param stats_sample: time one of this number of logs for
+                         :meth:`stats`, default is 64, 0 to disable
+    :param sample: a dict of the sampling of each level, an integer N
+                   to show one of N logs of each call site, or a float
+                   probability in ``(0, 1]`` to show a log
+    :param sample_budget: the max number of sampled logs per second
 
     Play with :class:`Logger`, it supports nested logging::
 
@@ -31,13 +549,42 @@ class Logger(object):
     """
 
     def __init__(self, **kwargs):
-        self._indent = 0
+        self._indent_var = None
+        self._indent_value = 0
         self._is_verbose = False
         self._enable_verbose = False
         self._enable_quiet = False
 
-        self.warn_count = 0
-        self.error_count = 0
+        self._counters = _Counters()
+
+        self._sink = ConsoleSink()
+        self._verbose_log = None
+        self._json = False
+        self._json_sink = None
+        self._extra = ''
+        self._extra_fields = {}
+        self._added_sinks = []
+        self._sinks = ()
+        self._sink_rank = 0
+        self._timing = False
+        self._spans = _Span('')
+        self._span_lock = threading.Lock()
+        self._span_var = None
+        self._span_value = ()
+        self._reports = []
+        self._filter_lock = threading.Lock()
+        self._dedupe = 0
+        self._dedupe_size = 256
+        self._recent = OrderedDict()
+        self._buckets = {}
+        self._backlog = None
+        # the hidden level methods count with one call of a counter
+        self._hidden_counts = {}
+        self._stats_sample = 64
+        self._samples = itertools.count(1)
+        self._sampling = {}
+        self._sample_sites = {}
+        self._sample_budget = None
 
         self.config(**kwargs)
 
@@ -54,13 +601,294 @@ class Logger(object):
 
             log.config(quiet=True)
 
+        Send the logs to another sink, e.g. a
+        :class:`~terminal.sink.BufferedSink`, and emit only the logs of
+        a level or above::
+
+            log.config(sink=BufferedSink(), level='warn')
+
+        More sinks can be added with :meth:`add_sink`.
+
+        Time the nested logs, the elapsed time is shown on :meth:`end`,
+        see :meth:`report_spans` for the summary::
+
+            log.config(timing=True)
+
+        Hide the same logs repeated within 5 seconds, they are shown
+        later as one log with ``(repeated N times)``, and allow at most
+        10 warn logs per second::
+
+            log.config(dedupe=5, rate_limit={'warn': 10})
+
+        The suppressed logs are still counted in :attr:`warn_count` and
+        :attr:`error_count`.
+
+        Keep the last 1000 logs hidden by ``quiet`` or ``verbose``, they
+        are shown before the first error log, or by
+        :meth:`dump_backlog`::
+
+            log.config(quiet=True, backlog=1000)
+
+        Show one of 100 debug logs of each line calling it, and at most
+        50 sampled logs per second, every sampled log has an extra key
+        ``sample_rate``::
+
+            log.config(sample={'debug': 100}, sample_budget=50)
+
+        Log in many threads or asyncio tasks, each thread or task has
+        its own indent level::
+
+            log.config(concurrent=True)
+
+        Write the logs as JSON lines, or write JSON lines to a file and
+        keep the human logs on the terminal::
+
+            log.config(json=True)
+            log.config(json=open('app.log', 'a'), extra={'app': 'demo'})
+            log.info('uploaded', size=1024)
+
+        The disabled level methods are replaced by no-op functions, a
+        filtered log costs nothing more than a function call.
         """
+        if 'concurrent' in kwargs:
+            self._set_concurrent(kwargs.get('concurrent', False))
         if 'indent' in kwargs:
-            self._indent = kwargs.get('indent', 0)
+            self._indent_value = kwargs.get('indent', 0)
+            self._indent = self._indent_value
         if 'verbose' in kwargs:
             self._enable_verbose = kwargs.get('verbose', False)
         if 'quiet' in kwargs:
             self._enable_quiet = kwargs.get('quiet', False)
+        if 'sink' in kwargs:
+            self._sink = kwargs.get('sink') or ConsoleSink()
+        if 'level' in kwargs:
+            self._sink_rank = LEVELS[kwargs.get('level') or 'debug']
+        if 'json' in kwargs:
+            self._set_json(kwargs.get('json'))
+        if 'timing' in kwargs:
+            self._timing = bool(kwargs.get('timing'))
+        if 'dedupe_size' in kwargs:
+            self._dedupe_size = kwargs.get('dedupe_size') or 256
+        if 'dedupe' in kwargs:
+            self.flush_repeats()
+            self._recent.clear()
+            self._dedupe = kwargs.get('dedupe') or 0
+            if self._dedupe:
+                _dedupe_loggers.add(self)
+            else:
+                _dedupe_loggers.discard(self)
+        if 'rate_limit' in kwargs:
+            self._buckets = {}
+            for level, rate in (kwargs.get('rate_limit') or {}).items():
+                if not isinstance(rate, (tuple, list)):
+                    rate = (rate,)
+                self._buckets[level] = _TokenBucket(*rate)
+        if 'sample' in kwargs:
+            sampling = dict(kwargs.get('sample') or {})
+            for level, value in sampling.items():
+                if isinstance(value, bool) or not (
+                        isinstance(value, integer_types) and value >= 1 or
+                        isinstance(value, float) and 0 < value <= 1):
+                    raise ValueError(
+                        'invalid sample of %s: %r' % (level, value))
+            self._sampling = sampling
+            self._sample_sites = {}
+        if 'sample_budget' in kwargs:
+            budget = kwargs.get('sample_budget')
+            self._sample_budget = budget and _TokenBucket(budget) or None
+        if 'stats_sample' in kwargs:
+            self._stats_sample = kwargs.get('stats_sample') or 0
+        if 'backlog' in kwargs:
+            size = kwargs.get('backlog')
+            self._backlog = size and _Backlog(size) or None
+        if 'extra' in kwargs:
+            self._extra_fields = dict(kwargs.get('extra') or {})
+            self._extra = _json_fields(self._extra_fields)
+        self._build_sinks()
+        return self
+
+    def add_sink(self, sink, level='debug', formatter=None):
+        """
+        Send the logs to one more sink, with its own level threshold
+        and formatter::
+
+            log.add_sink(StreamSink(open('app.log', 'a')), 'info', 'json')
+
+        Each log is formatted once for every formatter, no matter how
+        many sinks use it. The sinks below the threshold are skipped
+        before formatting.
+
+        :param sink: a sink, or a stream to write into
+        :param level: the lowest level of logs to emit
+        :param formatter: ``human``, ``json``, or a function with the
+                          same arguments as :func:`format_json`, default
+                          is the ``formatter`` of the sink or ``human``
+        """
+
+        if not hasattr(sink, 'emit'):
+            sink = StreamSink(sink)
+        if formatter is None:
+            formatter = getattr(sink, 'formatter', 'human')
+        if formatter not in _formatters and not callable(formatter):
+            raise ValueError('invalid formatter: %s' % formatter)
+        self._added_sinks.append(
+            (LEVELS[level], formatter, sink, _stream_name(sink)))
+        self._build_sinks()
+        return sink
+
+    def remove_sink(self, sink):
+        """
+        Remove a sink added by :meth:`add_sink`, it is flushed.
+        """
+
+        self._added_sinks = [
+            entry for entry in self._added_sinks if entry[2] is not sink
+        ]
+        self._build_sinks()
+        sink.flush()
+        return self
+
+    def _build_sinks(self):
+        formatter = getattr(self._sink, 'formatter', 'human')
+        if self._json and formatter == 'human':
+            formatter = 'json'
+        sinks = [(self._sink_rank, formatter, self._sink,
+                  _stream_name(self._sink))]
+        if self._json_sink is not None:
+            sinks.append((self._sink_rank, 'json', self._json_sink,
+                          _stream_name(self._json_sink)))
+        sinks.extend(self._added_sinks)
+        self._sinks = tuple(sinks)
+        self._min_rank = min(entry[0] for entry in sinks)
+        self._bind_levels()
+
+    def _set_json(self, value):
+        self._json = value is True
+        if value is True or not value:
+            self._json_sink = None
+        elif hasattr(value, 'emit'):
+            self._json_sink = value
+        else:
+            self._json_sink = StreamSink(value)
+
+    def _set_concurrent(self, enable):
+        indent = self._indent
+        stack = self._span_stack
+        values = self._counters.items()
+        if enable:
+            if ContextVar is not None:
+                self._indent_var = ContextVar('terminal_log_indent',
+                                              default=None)
+                self._span_var = ContextVar('terminal_log_spans',
+                                            default=())
+            else:  # pragma: no cover
+                self._indent_var = _LocalVar('terminal_log_indent')
+                self._span_var = _LocalVar('terminal_log_spans', ())
+            self._counters = _ThreadCounters(values)
+        else:
+            self._indent_var = None
+            self._span_var = None
+            self._counters = _Counters(values)
+        self._indent = indent
+        self._span_stack = stack
+
+    @property
+    def _span_stack(self):
+        # a tuple of (span, start time), it is never changed in place,
+        # so the copied contexts of asyncio tasks do not share it
+        if self._span_var is None:
+            return self._span_value
+        return self._span_var.get()
+
+    @_span_stack.setter
+    def _span_stack(self, stack):
+        if self._span_var is None:
+            self._span_value = stack
+        else:
+            self._span_var.set(stack)
+
+    @property
+    def _indent(self):
+        if self._indent_var is None:
+            return self._indent_value
+        indent = self._indent_var.get()
+        if indent is None:
+            # a new thread or context starts at the configured indent
+            return self._indent_value
+        return indent
+
+    @_indent.setter
+    def _indent(self, indent):
+        if self._indent_var is None:
+            self._indent_value = indent
+        else:
+            self._indent_var.set(indent)
+
+    @property
+    def warn_count(self):
+        """The count of warn logs."""
+        return self._counters.get(0)
+
+    @warn_count.setter
+    def warn_count(self, value):
+        self._counters.set(0, value)
+
+    @property
+    def error_count(self):
+        """The count of error logs."""
+        return self._counters.get(1)
+
+    @error_count.setter
+    def error_count(self, value):
+        self._counters.set(1, value)
+
+    def _bind_levels(self):
+        for name in ('debug', 'info'):
+            if self._enable_quiet or LEVELS[name] < self._min_rank:
+                self.__dict__[name] = self._hidden(self, name)
+            else:
+                self.__dict__.pop(name, None)
+
+        if self._verbose_log is not None:
+            self._verbose_log._bind_levels()
+
+    def _hidden(self, log, level):
+        # a level method of disabled logs, it only counts them, and
+        # keeps them in the backlog
+        # config() binds them again when the counters or backlog change
+        index = {'warn': 0, 'error': 1}.get(level)
+        counter = self._hidden_counts.get(level)
+        if counter is None:
+            counter = self._hidden_counts.setdefault(level, itertools.count())
+        count = _next_method(counter)
+        add = self._counters.add
+        backlog = self._backlog
+
+        if index is None and backlog is None:
+            def hidden(*args, **extra):
+                count()
+                return log
+            return hidden
+
+        def hidden(*args, **extra):
+            if index is not None:
+                add(index)
+            count()
+            if backlog is not None:
+                backlog.append((level, args, extra, self._indent))
+            return log
+        return hidden
+
+    def dump_backlog(self):
+        """
+        Show the hidden logs kept by ``backlog`` in order, with their
+        original indent levels.
+        """
+
+        if self._backlog is None:
+            return self
+        for level, args, extra, indent in self._backlog.drain():
+            self._write(level, args, extra, force=True, indent=indent)
         return self
 
     def message(self, level, *args):
@@ -72,30 +900,264 @@ class Logger(object):
             class MyLogger(Logger):
 
                 def message(self, level, *args):
-                    msg = ' '.join(args)
+                    msg = format_args(args)
 
                     if level == 'error':
                         return terminal.red(msg)
                     return msg
         """
 
-        msg = ' '.join((str(o) for o in args))
+        msg = format_args(args)
         if level not in ('start', 'end', 'debug', 'info', 'warn', 'error'):
             return msg
         return '%s: %s' % (level, msg)
 
-    def writeln(self, level='info', *args):
-        if not self._enable_verbose and self._is_verbose:
+    def writeln(self, level='info', *args, **extra):
+        if self._sampling and level in self._sampling:
+            rate = self._sample(level)
+            if not rate:
+                self._suppress(level, args, extra)
+                return self
+            extra['sample_rate'] = rate
+        if self._dedupe or self._buckets:
+            filtered = self._filter(level, args, extra)
+            if filtered is None:
+                return self
+            args, extra = filtered
+        return self._write(level, args, extra)
+
+    def _filter(self, level, args, extra):
+        now = _clock()
+        with self._filter_lock:
+            repeated = 0
+            if self._dedupe:
+                key = (level, tuple(args))
+                try:
+                    hash(key)
+                except TypeError:
+                    key = (level, format_args(args))
+                entry = self._recent.get(key)
+                if entry is not None and now - entry[0] < self._dedupe:
+                    entry[1] += 1
+                    self._suppress(level, args, extra)
+                    return None
+                if entry is not None:
+                    repeated = entry[1]
+                    del self._recent[key]
+                # a copy, the annotations of this log are not repeated
+                self._recent[key] = [now, 0, level, args, dict(extra)]
+                if len(self._recent) > self._dedupe_size:
+                    evicted = self._recent.popitem(last=False)[1]
+                else:
+                    evicted = None
+
+            dropped = 0
+            bucket = self._buckets.get(level)
+            if bucket is not None:
+                if not bucket.take(now):
+                    self._suppress(level, args, extra)
+                    return None
+                dropped = bucket.dropped
+                bucket.dropped = 0
+
+        if self._dedupe and evicted is not None and evicted[1]:
+            self._write_repeated(*evicted)
+        if repeated or dropped:
+            msg = format_args(args)
+            extra = dict(extra)
+            if repeated:
+                msg = '%s (repeated %d times)' % (msg, repeated)
+                extra['repeated'] = repeated
+            if dropped:
+                msg = '%s (%d more suppressed)' % (msg, dropped)
+                extra['dropped'] = dropped
+            args = (msg,)
+        return args, extra
+
+    def _sample(self, level):
+        # decide on the call site before anything is formatted, return
+        # the sample rate, or 0 if the log is dropped
+        value = self._sampling[level]
+        if isinstance(value, float) and value < 1:
+            if random.random() >= value:
+                return 0
+            rate = 1 / value
+        else:
+            frame = sys._getframe(1)
+            while frame.f_back and frame.f_code.co_filename == _this_file:
+                frame = frame.f_back
+            key = (level, frame.f_code, frame.f_lineno)
+            counter = self._sample_sites.get(key)
+            if counter is None:
+                counter = self._sample_sites.setdefault(key, itertools.count())
+            if next(counter) % value:
+                return 0
+            rate = value
+
+        bucket = self._sample_budget
+        if bucket is not None:
+            with self._filter_lock:
+                if not bucket.take(_clock()):
+                    return 0
+        return rate
+
+    def _suppress(self, level, args, extra):
+        self._counters.add(('suppressed', level))
+
+    def _write_repeated(self, updated, repeated, level, args, extra):
+        msg = '%s (repeated %d times)' % (format_args(args), repeated)
+        extra = dict(extra, repeated=repeated)
+        self._write(level, (msg,), extra)
+
+    def flush_repeats(self):
+        """
+        Show the pending ``(repeated N times)`` logs of duplicates.
+        """
+
+        entries = []
+        with self._filter_lock:
+            for entry in self._recent.values():
+                if entry[1]:
+                    entries.append(list(entry))
+                    entry[1] = 0
+        for entry in entries:
+            self._write_repeated(*entry)
+        return self
+
+    def _write(self, level, args, extra, force=False, indent=None):
+        if indent is None:
+            indent = self._indent
+        counters = self._counters
+        sinks = self._sinks
+        sample = self._stats_sample
+        timed = sample and next(self._samples) % sample == 0
+        if not timed and len(sinks) == 1 and sinks[0][:2] == (0, 'human'):
+            text = self._format_human(level, args, indent)
+            sinks[0][2].emit(level, text)
+            counters.add(('records', level))
+            name = sinks[0][3] or (level == 'error' and 'stderr' or 'stdout')
+            counters.add(('bytes', name), _byte_size(text))
+            return self
+
+        rank = LEVELS.get(level, 20)
+        if not force:
+            sinks = [entry for entry in sinks if rank >= entry[0]]
+        if not sinks:
+            counters.add(('suppressed', level))
             return self
+        if len(sinks) > 1:
+            # evaluate the lazy arguments once for all formatters
+            args = [_evaluate(o) for o in args]
+
+        texts = {}
+        format_time = io_time = 0.0
+        for min_rank, formatter, sink, name in sinks:
+            text = texts.get(formatter)
+            if text is None:
+                begin = timed and _clock()
+                text = texts[formatter] = self._format(
+                    formatter, level, args, extra, indent)
+                if timed:
+                    format_time += _clock() - begin
+            begin = timed and _clock()
+            sink.emit(level, text)
+            if timed:
+                io_time += _clock() - begin
+            if formatter != 'record':
+                name = name or (level == 'error' and 'stderr' or 'stdout')
+                counters.add(('bytes', name), _byte_size(text))
+        counters.add(('records', level))
+        if timed:
+            counters.add('samples')
+            counters.add('format_seconds', format_time)
+            counters.add('io_seconds', io_time)
+        return self
+
+    def _format(self, formatter, level, args, extra, indent):
+        if formatter == 'human':
+            return self._format_human(level, args, indent)
+        if formatter == 'json':
+            if extra:
+                extra = self._extra + _json_fields(extra)
+            else:
+                extra = self._extra
+            return format_json(level, format_args(args), indent, extra=extra)
+        if formatter == 'record':
+            # a compact record for QueueSink
+            return (level, format_args(args), indent, extra or None,
+                    self.warn_count, self.error_count)
+        if self._extra_fields:
+            fields = dict(self._extra_fields)
+            fields.update(extra)
+            extra = fields
+        return formatter(level, format_args(args), indent, None, extra)
+
+    def _format_human(self, level, args, indent):
         msg = self.message(level, *args)
-        if self._indent:
-            msg = '%s%s' % ('  ' * self._indent, msg)
-        if level == 'error':
-            sys.stderr.write('%s\n' % msg)
-        else:
-            sys.stdout.write('%s\n' % msg)
+        if indent:
+            msg = '%s%s' % ('  ' * indent, msg)
+        return '%s\n' % msg
+
+    def flush(self):
+        """
+        Flush the logs buffered in the sinks.
+        """
+
+        if self._dedupe:
+            self.flush_repeats()
+        for min_rank, formatter, sink, name in self._sinks:
+            sink.flush()
         return self
 
+    @property
+    def suppressed(self):
+        """The number of suppressed logs of each level."""
+        return self.stats()['suppressed']
+
+    def stats(self, format=None):
+        """
+        Get the stats of this logger, the number of logs written and
+        suppressed of each level, the size in UTF-8 bytes of logs
+        written to each stream, and the estimated time spent in
+        formatting and writing logs, sampled on one of ``stats_sample``
+        logs::
+
+            >>> log.stats()['records']
+            {'info': 12, 'warn': 1}
+
+        :param format: None for a dict, or ``prometheus`` for the
+                       Prometheus text format
+        """
+
+        values = self._counters.items()
+        stats = {
+            'records': {},
+            'suppressed': {},
+            'bytes': {},
+            'warn_count': values.get(0, 0),
+            'error_count': values.get(1, 0),
+            'samples': values.get('samples', 0),
+            'sample_rate': self._stats_sample,
+            'format_seconds': 0.0,
+            'io_seconds': 0.0,
+        }
+        for key, value in values.items():
+            if isinstance(key, tuple) and value:
+                stats[key[0]][key[1]] = value
+        suppressed = stats['suppressed']
+        for level, counter in list(self._hidden_counts.items()):
+            value = _count_value(counter)
+            if value:
+                suppressed[level] = suppressed.get(level, 0) + value
+        if stats['samples']:
+            rate = self._stats_sample or 1
+            stats['format_seconds'] = values['format_seconds'] * rate
+            stats['io_seconds'] = values['io_seconds'] * rate
+
+        if format == 'prometheus':
+            return _format_prometheus(stats, 'terminal_log')
+        return stats
+
     @property
     def verbose(self):
         """
@@ -106,71 +1168,366 @@ class Logger(object):
 
             log.verbose.warn('this is a verbose warn')
             log.verbose.info('this is a verbose info')
+
+        The verbose log shares the indent level and the counters with
+        this log, the warn and error logs are counted even if they are
+        not shown.
         """
 
-        log = copy.copy(self)
-        log._is_verbose = True
-        return log
+        if self._verbose_log is None:
+            self._verbose_log = _VerboseLogger(self)
+        return self._verbose_log
 
-    def start(self, *args):
+    def start(self, *args, **extra):
         """
         Start a nested log.
         """
 
-        if self._is_verbose:
-            # verbose log has no start method
+        if not self._timing:
+            self.writeln('start', *args, **extra)
+            self._indent += 1
             return self
 
-        self.writeln('start', *args)
+        label = format_args(args)
+        self.writeln('start', label, **extra)
         self._indent += 1
+        stack = self._span_stack
+        parent = stack[-1][0] if stack else self._spans
+        self._span_stack = stack + ((parent.child(label), _clock()),)
         return self
 
-    def end(self, *args):
+    def end(self, *args, **extra):
         """
         End a nested log.
         """
 
-        if self._is_verbose:
-            # verbose log has no end method
-            return self
+        stack = self._timing and self._span_stack
+        if stack:
+            span, begin = stack[-1]
+            elapsed = _clock() - begin
+            self._span_stack = stack[:-1]
+            with self._span_lock:
+                span.count += 1
+                span.total += elapsed
+                if elapsed > span.max:
+                    span.max = elapsed
+            if args:
+                msg = '%s (%s)' % (format_args(args), _format_elapsed(elapsed))
+                extra['elapsed'] = round(elapsed, 6)
+                args = (msg,)
 
         if not args:
             self._indent -= 1
             return self
-        self.writeln('end', *args)
+        self.writeln('end', *args, **extra)
         self._indent -= 1
         return self
 
-    def debug(self, *args):
+    def spans(self):
+        """
+        Get the aggregated timing of the nested logs as a tree, every
+        node has ``label``, ``count``, ``total``, ``max`` seconds and
+        the ``children`` nodes.
+        """
+
+        with self._span_lock:
+            return self._spans.to_dict()['children']
+
+    def report_spans(self, stream=None, format='text'):
+        """
+        Write the summary of the timing spans, the text format is a
+        flame-style tree::
+
+            build              2.10s  100.0%  #################### x1
+              compile          1.70s   81.0%  ################     x12
+
+        :param stream: the output stream, default is stderr
+        :param format: ``text`` or ``json``
+        """
+
+        if stream is None:
+            stream = sys.stderr
+        if format == 'json':
+            stream.write(json.dumps(self.spans()))
+            stream.write('\n')
+            return self
+
+        with self._span_lock:
+            nodes = sorted(self._spans.children.values(),
+                           key=lambda n: -n.total)
+            if not nodes:
+                return self
+            total = sum(node.total for node in nodes)
+            scale = total and 1.0 / total
+            width = max(node.width(0) for node in nodes)
+            for node in nodes:
+                for line in node.lines(0, scale, width):
+                    stream.write(line.rstrip() + '\n')
+        return self
+
+    def report_at_exit(self, stream=None, format='text'):
+        """
+        Call :meth:`report_spans` at exit, it turns on timing.
+
+        :param stream: the output stream, or a file path
+        :param format: ``text`` or ``json``
+        """
+
+        self._timing = True
+        if not self._reports:
+            atexit.register(self._report_at_exit)
+        self._reports.append((stream, format))
+        return self
+
+    def _report_at_exit(self):
+        for stream, format in self._reports:
+            if isinstance(stream, string_type):
+                with open(stream, 'w') as f:
+                    self.report_spans(f, format)
+            else:
+                self.report_spans(stream, format)
+
+    def debug(self, *args, **extra):
         """
         The debug level log.
         """
 
         if self._enable_quiet:
             return self
-        return self.writeln('debug', *args)
+        return self.writeln('debug', *args, **extra)
 
-    def info(self, *args):
+    def info(self, *args, **extra):
         """
         The info level log.
         """
 
         if self._enable_quiet:
             return self
-        return self.writeln('info', *args)
+        return self.writeln('info', *args, **extra)
 
-    def warn(self, *args):
+    def warn(self, *args, **extra):
         """
         The warn level log.
         """
 
-        self.warn_count += 1
-        return self.writeln('warn', *args)
+        self._counters.add(0)
+        return self.writeln('warn', *args, **extra)
 
-    def error(self, *args):
+    def error(self, *args, **extra):
         """
         The error level log.
         """
 
-        self.error_count += 1
-        return self.writeln('error', *args)
+        self._counters.add(1)
+        backlog = self._backlog
+        if backlog is not None and not backlog.dumped:
+            backlog.dumped = True
+            self.dump_backlog()
+        return self.writeln('error', *args, **extra)
+
+
+class _VerboseLogger(object):
+    """
+    The verbose view of a :class:`Logger`, it shares the states with the
+    parent logger. When verbose is disabled, the level methods are bound
+    to functions that only update the counters.
+    """
+
+    _is_verbose = True
+
+    def __init__(self, parent):
+        self.__dict__['_parent'] = parent
+        self._bind_levels()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._parent, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._parent, name, value)
+
+    def _bind_levels(self):
+        names = ('debug', 'info', 'warn', 'error')
+        if self._parent._enable_verbose:
+            for name in names:
+                self.__dict__.pop(name, None)
+        else:
+            for name in names:
+                self.__dict__[name] = self._parent._hidden(self, name)
+
+    def writeln(self, level='info', *args, **extra):
+        if not self._parent._enable_verbose:
+            # count it like the hidden level methods
+            hidden = self.__dict__.get(level)
+            if hidden is not None:
+                hidden(*args, **extra)
+            return self
+        self._parent.writeln(level, *args, **extra)
+        return self
+
+    def start(self, *args, **extra):
+        # verbose log has no start method
+        return self
+
+    def end(self, *args, **extra):
+        # verbose log has no end method
+        return self
+
+    def debug(self, *args, **extra):
+        self._parent.debug(*args, **extra)
+        return self
+
+    def info(self, *args, **extra):
+        self._parent.info(*args, **extra)
+        return self
+
+    def warn(self, *args, **extra):
+        self._parent.warn(*args, **extra)
+        return self
+
+    def error(self, *args, **extra):
+        self._parent.error(*args, **extra)
+        return self
+
+
+def setup_worker(queue, log=None, **kwargs):
+    """
+    Send the logs of a worker process to a :class:`LogCollector`, it
+    can be the initializer of a process pool::
+
+        pool = multiprocessing.Pool(
+            4, initializer=setup_worker, initargs=(collector.queue,))
+
+    :param queue: the queue of the collector
+    :param log: the logger of the worker, default is ``terminal.log``
+    :param kwargs: more configs of the logger
+    """
+
+    if log is None:
+        import terminal
+        log = terminal.log
+    sink = kwargs['sink'] = QueueSink(queue)
+    log.config(**kwargs)
+    # the counters inherited from the parent are not counted again
+    log.warn_count = 0
+    log.error_count = 0
+
+    # the hidden warns and errors after the last record are sent at exit,
+    # before the finalizer of the queue, whose exit priority is 10
+    from multiprocessing.util import Finalize
+    Finalize(None, _send_counters, args=(sink, log), exitpriority=100)
+    return log
+
+
+def _send_counters(sink, log):
+    # a record without a level only carries the counters
+    sink.emit(None, (None, None, 0, None, log.warn_count, log.error_count))
+
+
+class LogCollector(object):
+    """
+    Collect the logs of worker processes, and write them with a logger
+    in the parent process. The logs of each worker keep their indent
+    levels, and are tagged with the pid of the worker. The logs of the
+    levels hidden by the logger, like debug when it is quiet, are not
+    shown. The warn and error counters of the workers are added to the
+    logger::
+
+        collector = LogCollector(log)
+        with collector:
+            pool = multiprocessing.Pool(
+                4, initializer=setup_worker, initargs=(collector.queue,))
+            pool.map(work, tasks)
+            pool.close()
+            pool.join()
+
+    :param log: the logger to write the logs, default is ``terminal.log``
+    :param queue: the queue to receive the records, default is a
+                  :class:`multiprocessing.Queue`
+    """
+
+    def __init__(self, log=None, queue=None):
+        if log is None:
+            import terminal
+            log = terminal.log
+        if queue is None:
+            import multiprocessing
+            queue = multiprocessing.Queue()
+        self.log = log
+        self.queue = queue
+        #: the stats of each worker, keyed by pid
+        self.workers = {}
+        self._thread = None
+
+    def start(self):
+        """
+        Start collecting the logs in a background thread.
+        """
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Write the remaining logs and stop collecting.
+        """
+
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        get = self.queue.get
+        while True:
+            record = get()
+            if record is None:
+                return
+            self.handle(record)
+
+    def handle(self, record):
+        """
+        Write a record sent by a :class:`~terminal.sink.QueueSink`.
+        """
+
+        pid, level, message, indent, extra, warns, errors = record
+        worker = self.workers.get(pid)
+        if worker is None and level is None and not (warns or errors):
+            # the final counters of a worker without any log
+            return
+        if worker is None:
+            worker = self.workers[pid] = {
+                'records': 0, 'warn_count': 0, 'error_count': 0,
+            }
+
+        log = self.log
+        if warns > worker['warn_count']:
+            log._counters.add(0, warns - worker['warn_count'])
+            worker['warn_count'] = warns
+        if errors > worker['error_count']:
+            log._counters.add(1, errors - worker['error_count'])
+            worker['error_count'] = errors
+        if level is None:
+            # the final counters of the worker
+            return
+        worker['records'] += 1
+
+        extra = dict(extra or (), pid=pid)
+        message = '[%d] %s' % (pid, message)
+        hidden = log.__dict__.get(level)
+        if hidden is not None:
+            # a level disabled by quiet or the level of the logger
+            hidden(message, **extra)
+            return
+        log._write(level, (message,), extra, indent=log._indent + indent)
@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+"""
+    terminal.sink
+    ~~~~~~~~~~~~~
+
+    Output sinks for terminal logger.
+
+    :copyright: (c) 2013 by Hsiaoming Yang.
+"""
+
+import os
+import sys
+import time
+import atexit
+import signal
+import itertools
+import threading
+import weakref
+
+from .color import strip_ansi
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+
+#: the rank of each log level
+LEVELS = {
+    'debug': 10,
+    'info': 20,
+    'start': 20,
+    'end': 20,
+    'warn': 30,
+    'error': 40,
+}
+
+
+_console_lock = threading.Lock()
+
+
+class ConsoleSink(object):
+    """
+    The default sink of :class:`~terminal.Logger`, error logs go to
+    stderr, other logs go to stdout. Each record is written in one call
+    under a lock, the lines of many threads never interleave.
+    """
+
+    def emit(self, level, text):
+        with _console_lock:
+            if level == 'error':
+                sys.stderr.write(text)
+            else:
+                sys.stdout.write(text)
+
+    def flush(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    def close(self):
+        self.flush()
+
+
+class StreamSink(object):
+    """
+    Write the logs to a stream, e.g. a file. Each record is written in
+    one call under a lock.
+
+    :param stream: the output stream, it is not closed by the sink
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def emit(self, level, text):
+        with self._lock:
+            self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+
+
+class QueueSink(object):
+    """
+    Send the logs of a worker process to a queue as compact records,
+    they are written by a :class:`~terminal.log.LogCollector` in the
+    parent process. See :func:`~terminal.log.setup_worker`.
+
+    :param queue: a queue shared with the parent process
+    """
+
+    #: Logger formats the logs into records for this sink
+    formatter = 'record'
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def emit(self, level, record):
+        self.queue.put((os.getpid(),) + record)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _WeakSet(object):
+    # the add, discard and iteration of weakref.WeakSet, which is new in
+    # Python 2.7
+
+    def __init__(self):
+        self._refs = {}
+
+    def add(self, item):
+        key = id(item)
+        refs = self._refs
+
+        def remove(ref):
+            if refs.get(key) is ref:
+                del refs[key]
+        refs[key] = weakref.ref(item, remove)
+
+    def discard(self, item):
+        ref = self._refs.get(id(item))
+        if ref is not None and ref() is item:
+            del self._refs[id(item)]
+
+    def __iter__(self):
+        for ref in list(self._refs.values()):
+            item = ref()
+            if item is not None:
+                yield item
+
+    def __len__(self):
+        return sum(1 for item in self)
+
+
+WeakSet = getattr(weakref, 'WeakSet', _WeakSet)
+_buffered_sinks = WeakSet()
+
+
+class BufferedSink(object):
+    """
+    A sink that batches log records into large writes.
+
+    The records are buffered, and written at once when the buffer is
+    full, when the buffer is older than ``flush_interval``, or when a
+    record of ``flush_level`` comes. A timer flushes the buffer after
+    ``flush_interval`` when no more records come. In ``background`` mode, the
+    records are passed to a writer thread through a bounded queue, so
+    a slow stream never blocks the logging thread::
+
+        log.config(sink=BufferedSink(background=True, policy='drop'))
+
+    The buffers are flushed at exit, call :func:`flush_on_signals` to
+    flush them on fatal signals too.
+
+    :param stream: the output stream, default is stdout, with error
+                   logs written to stderr
+    :param buffer_size: flush when the buffer exceeds this size
+    :param flush_interval: flush when the buffer is older than this
+                           number of seconds
+    :param flush_level: flush immediately on logs of this level or above
+    :param background: write the records in a background thread
+    :param queue_size: the max number of records in the queue
+    :param policy: ``block`` or ``drop`` the records when the queue is
+                   full, the records of ``flush_level`` always block
+    """
+
+    def __init__(self, stream=None, buffer_size=65536, flush_interval=1.0,
+                 flush_level='error', background=False, queue_size=1024,
+                 policy='block'):
+        if policy not in ('block', 'drop'):
+            raise ValueError('invalid policy: %s' % policy)
+
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_level = LEVELS[flush_level]
+        self.policy = policy
+
+        #: the number of records dropped when the queue is full
+        self.dropped = 0
+        #: the number of records written to the stream
+        self.written = 0
+
+        self._buffer = []
+        self._size = 0
+        self._flushed_at = time.time()
+        self._lock = threading.RLock()
+        self._dropped_lock = threading.Lock()
+        self._closed = False
+        self._timer = None
+
+        self._queue = None
+        self._thread = None
+        if background:
+            self._queue = queue.Queue(queue_size)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+        _buffered_sinks.add(self)
+
+    def emit(self, level, text):
+        if self._queue is None:
+            with self._lock:
+                self._append(level, text)
+                if self._buffer and self._timer is None:
+                    self._timer = _start_timer(self)
+            return
+
+        # the records of flush_level are never dropped, they block
+        urgent = LEVELS.get(level, 0) >= self.flush_level
+        if self.policy == 'block' or urgent:
+            self._queue.put((level, text))
+        else:
+            try:
+                self._queue.put_nowait((level, text))
+            except queue.Full:
+                with self._dropped_lock:
+                    self.dropped += 1
+                return
+
+        if urgent:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all the buffered records.
+        """
+
+        if self._queue is not None and self._thread.is_alive():
+            # wait for the writer thread to write the queued records
+            done = threading.Event()
+            self._queue.put((None, done))
+            done.wait()
+            return
+
+        with self._lock:
+            self._write()
+
+    def close(self):
+        """
+        Flush the records and stop the writer thread.
+        """
+
+        if self._closed:
+            return
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._queue is not None and self._thread.is_alive():
+            self._queue.put((None, None))
+            self._thread.join()
+        with self._lock:
+            self._write()
+        _buffered_sinks.discard(self)
+
+    def _flush_timer(self):
+        with self._lock:
+            self._timer = None
+            self._write()
+
+    def _append(self, level, text):
+        if level == 'error' and self.stream is None:
+            # keep the order with the buffered stdout logs
+            self._write()
+            sys.stderr.write(text)
+            sys.stderr.flush()
+            self.written += 1
+            return
+
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size or \
+                LEVELS.get(level, 0) >= self.flush_level or \
+                time.time() - self._flushed_at >= self.flush_interval:
+            self._write()
+
+    def _write(self):
+        self._flushed_at = time.time()
+        if not self._buffer:
+            return
+
+        stream = self.stream
+        if stream is None:
+            stream = sys.stdout
+        stream.write(''.join(self._buffer))
+        stream.flush()
+        self.written += len(self._buffer)
+        self._buffer = []
+        self._size = 0
+
+    def _run(self):
+        get = self._queue.get
+        while True:
+            try:
+                level, item = get(timeout=self.flush_interval)
+            except queue.Empty:
+                with self._lock:
+                    self._write()
+                continue
+
+            with self._lock:
+                if level is not None:
+                    self._append(level, item)
+                    continue
+
+                self._write()
+                if item is None:
+                    # closed
+                    return
+                item.set()
+
+
+class RotatingFileSink(object):
+    """
+    Write the logs to a file, and rotate it by size or time::
+
+        sink = RotatingFileSink('app.log', max_bytes=1 << 20, backups=3,
+                                compress='gzip')
+        log.add_sink(sink, 'info')
+
+    The records are written on a raw file descriptor in large writes,
+    and flushed by a timer, like :class:`BufferedSink`. The rotated
+    files are ``app.log.1``, ``app.log.2``, and so on, the oldest ones
+    beyond ``backups`` are removed. The colors are stripped.
+
+    Rotating only renames the file, a background thread compresses it
+    and shifts the backups, so logging never waits for them.
+
+    :param path: the path of the log file
+    :param max_bytes: rotate when the file exceeds this size, 0 to
+                      disable
+    :param interval: rotate when the file is older than this number of
+                     seconds
+    :param backups: the number of rotated files to keep
+    :param compress: compress the rotated files with ``gzip`` or
+                     ``lzma`` in a background thread
+    :param buffer_size: flush when the buffer exceeds this size
+    :param flush_interval: flush when the buffer is older than this
+                           number of seconds
+    :param flush_level: flush immediately on logs of this level or above
+    """
+
+    def __init__(self, path, max_bytes=10 << 20, interval=None, backups=5,
+                 compress=None, buffer_size=65536, flush_interval=1.0,
+                 flush_level='error', encoding='utf-8'):
+        if compress == 'gzip':
+            self.suffix = '.gz'
+        elif compress == 'lzma':
+            self.suffix = '.xz'
+        elif not compress:
+            self.suffix = ''
+        else:
+            raise ValueError('invalid compress: %s' % compress)
+        if compress:
+            # fail early if the module is missing
+            __import__(compress)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backups = backups
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_level = LEVELS[flush_level]
+        self.encoding = encoding
+
+        self._buffer = []
+        self._size = 0
+        self._flushed_at = time.time()
+        self._lock = threading.RLock()
+        self._rotated = None
+        self._rotator = None
+        self._rotations = itertools.count(1)
+        self._timer = None
+        self._fd = None
+        self._open()
+        _buffered_sinks.add(self)
+
+    def _open(self):
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        self._fd = os.open(self.path, flags, 0o644)
+        self._file_size = os.fstat(self._fd).st_size
+        self._opened_at = time.time()
+
+    def emit(self, level, text):
+        if '\x1b' in text:
+            text = strip_ansi(text)
+        data = text.encode(self.encoding)
+        with self._lock:
+            self._buffer.append(data)
+            self._size += len(data)
+            if self._size >= self.buffer_size or \
+                    LEVELS.get(level, 0) >= self.flush_level or \
+                    time.time() - self._flushed_at >= self.flush_interval:
+                self._write()
+            elif self._timer is None:
+                self._timer = _start_timer(self)
+
+    def flush(self):
+        """
+        Write all the buffered records.
+        """
+
+        with self._lock:
+            self._write()
+
+    def close(self):
+        """
+        Flush the records, close the file and wait for the compression.
+        """
+
+        with self._lock:
+            if self._fd is None:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+            self._write()
+            os.close(self._fd)
+            self._fd = None
+        if self._rotator is not None:
+            # wait for the rotated files to be compressed and shifted
+            self._rotated.put(None)
+            self._rotator.join()
+            self._rotator = None
+        _buffered_sinks.discard(self)
+
+    def _flush_timer(self):
+        with self._lock:
+            self._timer = None
+            self._write()
+
+    def _write(self):
+        self._flushed_at = time.time()
+        if not self._buffer or self._fd is None:
+            return
+
+        if self.max_bytes and self._file_size and \
+                self._file_size + self._size > self.max_bytes:
+            self.rotate()
+        elif self.interval and \
+                self._flushed_at - self._opened_at >= self.interval:
+            self.rotate()
+
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+        self._file_size += len(data)
+
+    def rotate(self):
+        """
+        Rotate the log file now.
+        """
+
+        with self._lock:
+            os.close(self._fd)
+            if self.backups:
+                # a unique name, the backups are shifted in the background
+                rotated = '%s.%d.%d' % (
+                    self.path, os.getpid(), next(self._rotations))
+                os.rename(self.path, rotated)
+                if self._rotator is None:
+                    self._rotated = queue.Queue()
+                    self._rotator = threading.Thread(target=self._run)
+                    self._rotator.daemon = True
+                    self._rotator.start()
+                self._rotated.put(rotated)
+            else:
+                os.remove(self.path)
+            self._open()
+
+    def _run(self):
+        get = self._rotated.get
+        while True:
+            rotated = get()
+            if rotated is None:
+                return
+            self._finish_rotation(rotated)
+
+    def _finish_rotation(self, rotated):
+        source = rotated
+        if self.compress:
+            source = rotated + self.suffix
+            _compress_file(rotated, source, self.compress)
+
+        name = '%s.%%d%s' % (self.path, self.suffix)
+        for index in range(self.backups, 0, -1):
+            backup = name % index
+            if not os.path.exists(backup):
+                continue
+            if index >= self.backups:
+                os.remove(backup)
+            else:
+                os.rename(backup, name % (index + 1))
+        os.rename(source, name % 1)
+
+
+def _start_timer(sink):
+    # flush the buffer after flush_interval, when no record comes to
+    # check its age, one timer is pending for a sink at a time
+    timer = threading.Timer(sink.flush_interval, sink._flush_timer)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def _compress_file(source, target, compress):
+    module = __import__(compress)
+    with open(source, 'rb') as f:
+        with module.open(target + '.tmp', 'wb') as out:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                out.write(chunk)
+    os.rename(target + '.tmp', target)
+    os.remove(source)
+
+
+def _close_buffered_sinks():
+    for sink in list(_buffered_sinks):
+        sink.close()
+
+
+atexit.register(_close_buffered_sinks)
+
+
+def flush_on_signals(*signums):
+    """
+    Flush the :class:`BufferedSink` buffers when the process receives
+    one of the fatal signals, default is ``SIGTERM``. The previous
+    signal handlers are still called::
+
+        flush_on_signals(signal.SIGTERM, signal.SIGHUP)
+    """
+
+    if not signums:
+        signums = (signal.SIGTERM,)
+
+    for signum in signums:
+        previous = signal.getsignal(signum)
+
+        def handler(signum, frame, previous=previous):
+            for sink in list(_buffered_sinks):
+                sink.flush()
+            if callable(previous):
+                return previous(signum, frame)
+            if previous != signal.SIG_IGN:
+                # the default action of the signal
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signum, handler)
@@ -1,5 +1,11 @@
+# coding: utf-8
+
 import os
+import sys
+import threading
+import subprocess
 import terminal
+from terminal import color
 from nose.tools import raises
 
 
@@ -59,6 +65,346 @@ def test_raise_colorize():
     print(terminal.colorize('text', {'foo': 'bar'}))
 
 
+def test_rgb2ansi_array():
+    colors = [
+        (0, 0, 0), (2, 2, 2), (3, 2, 2), (45, 44, 46), (80, 80, 80),
+        (255, 0, 0), (128, 200, 16), (255, 255, 255), (214, 215, 216),
+        (1.5, 300, -2),
+    ]
+    expected = [terminal.rgb2ansi(*rgb) for rgb in colors]
+
+    numpy = color._get_numpy()
+    color._numpy = False
+    assert terminal.rgb2ansi_array(colors) == expected
+    color._numpy = numpy
+
+    if numpy is not None:
+        rv = terminal.rgb2ansi_array(numpy.array(colors[:-1], dtype='uint8'))
+        assert rv.tolist() == expected[:-1]
+        rv = terminal.rgb2ansi_array(numpy.array(colors))
+        assert rv.tolist() == expected
+        rv = terminal.rgb2ansi_array(numpy.array(colors[:4]).reshape(2, 2, 3))
+        assert rv.tolist() == [expected[:2], expected[2:4]]
+
+
+def test_lazy_numpy():
+    code = 'import sys, terminal; print("numpy" in sys.modules)'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=root,
+                               stdout=subprocess.PIPE)
+    assert process.communicate()[0].strip() == b'False'
+
+
+def test_hex2ansi_many():
+    codes = ['#ff0000', 'f00', '505050', 'abc', '#000', 'f00']
+    expected = [terminal.hex2ansi(code) for code in codes]
+    assert terminal.hex2ansi_many(codes) == expected
+
+
+def test_render_spans():
+    spans = [
+        (('red', None, (1,)), 'error'),
+        ((None, None, (1,)), ': '),
+        (None, 'file'),
+        (((0, 0, 255), None, ()), ' '),
+        ((None, None, (1, 2)), 'a'),
+        ((None, None, (2,)), 'b'),
+        ((None, 3, (2,)), ''),
+    ]
+    with terminal.override_profile(depth=0):
+        assert terminal.render_spans(spans) == 'error: file ab'
+
+    rv = terminal.render_spans(spans, terminal.TerminalProfile(depth=8))
+    assert rv == (
+        '\x1b[1;31merror\x1b[39m: \x1b[22mfile\x1b[34m '
+        '\x1b[1;2;39ma\x1b[22;2mb\x1b[0;39;49m'
+    )
+
+    rv = terminal.render_spans(spans[:3], terminal.TerminalProfile(depth=256))
+    assert rv == '\x1b[1;38;5;1merror\x1b[39m: \x1b[22mfile'
+
+
+def test_render_minimal():
+    with terminal.override_profile(depth=8):
+        line = terminal.red('a') + terminal.green('b') + 'c'
+        line = line + terminal.bold(terminal.red('d') + 'e')
+        assert line.render() == str(line)
+        assert line.render(minimal=True) == (
+            '\x1b[31ma\x1b[32mb\x1b[39mc\x1b[1;31md\x1b[39me\x1b[0;39;49m'
+        )
+
+
+def test_plain_text():
+    with terminal.override_profile(depth=0):
+        s = terminal.red('text')
+        assert isinstance(s, terminal.PlainText)
+        assert isinstance(s, str)
+        assert s == 'text'
+        assert terminal.bold(s) is s
+        assert s.bold.green_bg is s
+        assert s.render(minimal=True) == 'text'
+        assert s.items == ('text', )
+        assert s.fgcolor is None
+        assert s.style is terminal.Style()
+        assert s.spans() == [(terminal.Style(), 'text')]
+        assert str(terminal.colorize(s, 'f00')) == 'text'
+        assert str(s + terminal.Color('!')) == 'text!'
+        assert str(terminal.gray(terminal.Color('foo'))) == 'foo'
+
+        terminal.set_color_mode('always')
+        assert isinstance(terminal.red('text'), terminal.Color)
+        terminal.set_color_mode('auto')
+
+    with terminal.override_profile(depth=256):
+        terminal.set_color_mode('never')
+        assert isinstance(terminal.red('text'), terminal.PlainText)
+        terminal.set_color_mode('auto')
+        assert isinstance(terminal.red('text'), terminal.Color)
+
+
+def test_color_mode_never():
+    with terminal.override_profile(depth=256):
+        terminal.set_color_mode('never')
+        try:
+            text = terminal.Color('x').red
+            assert str(text) == 'x'
+            assert text.render() == 'x'
+            assert text.render(minimal=True) == 'x'
+            assert bytes(text.render_into(bytearray())) == b'x'
+            assert terminal.bold(text) == 'x'
+
+            line = color.compile('{0:bold.red}')
+            assert line('x') == 'x'
+            pixels = [[(255, 0, 0)], [(0, 0, 255)]]
+            assert terminal.render_image(pixels) == [' ']
+        finally:
+            terminal.set_color_mode('auto')
+        assert str(text).startswith('\x1b[')
+
+
+@raises(AttributeError)
+def test_plain_text_raise():
+    with terminal.override_profile(depth=0):
+        terminal.red('text').unknown
+
+
+@raises(ValueError)
+def test_color_mode_raise():
+    terminal.set_color_mode('sometimes')
+
+
+def test_render_into():
+    with terminal.override_profile(depth=256) as profile:
+        line = terminal.red('a') + 'b' + terminal.Color('c').bold + u'\u4e2d'
+        buf = line.render_into(bytearray())
+        assert bytes(buf) == str(line).encode('utf-8')
+
+        buf = line.render_into(bytearray(b'>'), 'utf-16-le', profile)
+        assert bytes(buf).endswith(u'\u4e2d'.encode('utf-16-le'))
+
+    with terminal.override_profile(depth=0):
+        text = terminal.red('a')
+        assert text.render_into(bytearray()) == bytearray(b'a')
+
+
+def test_byte_writer():
+    r, w = os.pipe()
+    try:
+        with terminal.override_profile(depth=8):
+            writer = terminal.ByteWriter(w, buffer_size=16)
+            writer.write(terminal.red('a'))
+            writer.write(b'b')
+            writer.write('c')
+            assert os.read(r, 100) == b'\x1b[31ma\x1b[0;39;49m'
+            writer.write(u'\u4e2d').flush()
+            assert os.read(r, 100) == b'bc\xe4\xb8\xad'
+
+        terminal.write_buffers(w, [b'foo', bytearray(b''), b'bar'])
+        assert os.read(r, 100) == b'foobar'
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def test_strip_ansi():
+    assert terminal.strip_ansi('text') == 'text'
+    assert terminal.strip_ansi('\x1b[1;31ma\x1b[0;39;49mb') == 'ab'
+    assert terminal.strip_ansi('\x1b]0;title\x07a\x1b]8;;url\x1b\\b') == 'ab'
+
+
+def test_visible_width():
+    assert terminal.visible_width('text') == 4
+    assert terminal.visible_width('\x1b[38;5;1mtext\x1b[0;39;49m') == 4
+    assert terminal.visible_width(u'\u4e2d\u6587') == 4
+    assert terminal.visible_width(u'e\u0301') == 1
+    assert terminal.visible_width(u'\u200ba\tb') == 2
+    assert terminal.visible_width(u'\U0001f600') == 2
+    assert terminal.visible_width(b'\xe4\xb8\xad') == 2
+    assert terminal.visible_width(42) == 2
+
+    s = terminal.Color(u'\u4e2d', terminal.Color('\x1b[1mtext').red)
+    assert len(s) == 6
+    assert terminal.visible_width(s) == 6
+
+
+def test_compile():
+    source = '{level:bold.red} {key:cyan:<6}={value} {{x}} {0!r:>5}'
+    profile = terminal.TerminalProfile(depth=8)
+    template = color.compile(source, profile)
+    assert color.compile(source, profile) is template
+    assert template.source == source
+
+    rv = template('a', level='error', key='key', value='value')
+    assert rv == (
+        '\x1b[1m\x1b[31merror\x1b[0;39;49m\x1b[0;39;49m '
+        '\x1b[36mkey   \x1b[0;39;49m=value {x}   \'a\''
+    )
+
+    template = color.compile(source, terminal.TerminalProfile(depth=0))
+    rv = template.format('a', level='error', key='key', value='value')
+    assert rv == "error key   =value {x}   'a'"
+
+    template = color.compile('{0:>3} {1:green_bg}', profile)
+    assert template(1, 2) == '  1 \x1b[42m2\x1b[0;39;49m'
+
+
+def test_format():
+    with terminal.override_profile(depth=8):
+        s = terminal.red(u'\u4e2d')
+        assert '{0}'.format(s) == str(s)
+        assert '{0:>4}'.format(s) == '  ' + str(s)
+        assert '{0:*^5}'.format(s) == '*' + str(s) + '**'
+        assert '{0:<1}'.format(s) == str(s)
+        assert '{0:3}'.format(s) == str(s) + ' '
+
+        s = terminal.red('abc') + terminal.green('def')
+        rv = str(terminal.red('abc') + terminal.green('d'))
+        assert '{0:.4}'.format(s) == rv
+        assert '{0:.2s}'.format(s) == str(terminal.red('ab'))
+        assert '{0:*<6.1}'.format(s) == str(terminal.red('a')) + '*****'
+        assert '{0:05}'.format(terminal.red('ab')) == 'ab000'
+
+
+def test_star_import():
+    scope = {}
+    exec('from terminal import *', scope)
+    assert 'compile' not in scope
+    assert 'threading' not in scope
+    assert 'red' in scope and 'Color' in scope
+
+
+def test_quantize():
+    assert terminal.quantize(255, 0, 0) == 9
+    assert terminal.quantize(255, 0, 0, colors=16) == 9
+    assert terminal.quantize(255, 0, 0, colors=8) == 1
+    assert terminal.quantize(0, 0, 0) == 0
+    assert terminal.quantize(78, 78, 78) == 239
+    assert terminal.quantize(135, 175, 215) == 110
+    assert terminal.quantize(300, -1, 0.5) == terminal.quantize(255, 0, 0)
+
+    for code in (0, 9, 110, 208, 239):
+        assert terminal.quantize(*terminal.ansi2rgb(code)) == code
+
+    assert terminal.ansi2rgb(9) == (255, 0, 0)
+    assert terminal.ansi2hex(110) == '#87afd7'
+    assert terminal.ansi2hex(239) == '#4e4e4e'
+
+
+@raises(ValueError)
+def test_quantize_raise():
+    terminal.quantize(0, 0, 0, colors=88)
+
+
+def test_downsample():
+    s = terminal.Color('text')
+    s.fgcolor = 110
+    assert s.render(terminal.TerminalProfile(depth=8)) == (
+        '\x1b[37mtext\x1b[0;39;49m'
+    )
+    assert s.render(terminal.TerminalProfile(depth=256)) == (
+        '\x1b[38;5;110mtext\x1b[0;39;49m'
+    )
+
+
+def test_truecolor():
+    truecolor = terminal.TerminalProfile.TRUECOLOR
+    with terminal.override_profile(depth=truecolor) as profile:
+        s = terminal.colorize('text', '#87afd7')
+        assert s.fgcolor == (135, 175, 215)
+        assert s.style is terminal.colorize('text', [135, 175, 215]).style
+
+        assert str(s) == '\x1b[38;2;135;175;215mtext\x1b[0;39;49m'
+        assert s.render(terminal.TerminalProfile(depth=256)) == (
+            '\x1b[38;5;110mtext\x1b[0;39;49m'
+        )
+        assert s.render(terminal.TerminalProfile(depth=8)) == (
+            '\x1b[37mtext\x1b[0;39;49m'
+        )
+
+        s = terminal.colorize('text', 'f00', background=True).bold
+        assert s.render(profile) == (
+            '\x1b[1m\x1b[48;2;255;0;0mtext\x1b[0;39;49m\x1b[0;39;49m'
+        )
+        assert s.render(profile, minimal=True) == (
+            '\x1b[1;48;2;255;0;0mtext\x1b[0;39;49m'
+        )
+        assert str(terminal.red('text')) == '\x1b[38;5;1mtext\x1b[0;39;49m'
+
+
+def test_render_image():
+    pixels = [
+        [(255, 0, 0), (255, 0, 0), (0, 0, 255)],
+        [(0, 255, 0), (0, 255, 0), (0, 0, 255)],
+        [(0, 0, 0), (1, 1, 1), (300, -1, 2)],
+    ]
+
+    profile = terminal.TerminalProfile(depth=256)
+    lines = terminal.render_image(pixels, profile)
+    assert lines == [
+        u'\x1b[38;5;196;48;5;46m▀▀'
+        u'\x1b[38;5;21;48;5;21m▀\x1b[0;39;49m',
+        u'\x1b[38;5;232;49m▀▀\x1b[38;5;196m▀\x1b[0;39;49m',
+    ]
+
+    profile = terminal.TerminalProfile(depth=8)
+    lines = terminal.render_image(pixels, profile)
+    assert lines[0] == u'\x1b[31;42m▀▀\x1b[34;44m▀\x1b[0;39;49m'
+
+    truecolor = terminal.TerminalProfile.TRUECOLOR
+    profile = terminal.TerminalProfile(depth=truecolor)
+    lines = list(terminal.iter_image(pixels, profile))
+    assert lines[1] == (
+        u'\x1b[38;2;0;0;0;49m▀\x1b[38;2;1;1;1m▀'
+        u'\x1b[38;2;255;0;2m▀\x1b[0;39;49m'
+    )
+
+    profile = terminal.TerminalProfile(depth=0)
+    assert terminal.render_image(pixels, profile) == ['   ', '   ']
+
+    numpy = color._get_numpy()
+    if numpy is not None:
+        for depth in (8, 256, truecolor):
+            profile = terminal.TerminalProfile(depth=depth)
+            lines = terminal.render_image(numpy.array(pixels), profile)
+            color._numpy = False
+            assert terminal.render_image(pixels, profile) == lines
+            color._numpy = numpy
+
+        # runs of random colors, which end at the end of lines
+        pixels = numpy.random.randint(0, 3, (7, 9, 3)) * 120
+        for depth in (8, 256, truecolor):
+            profile = terminal.TerminalProfile(depth=depth)
+            lines = terminal.render_image(pixels, profile)
+            color._numpy = False
+            assert terminal.render_image(pixels.tolist(), profile) == lines
+            color._numpy = numpy
+
+        pixels = numpy.zeros((3, 0, 3))
+        assert terminal.render_image(pixels, profile) == ['', '']
+    assert terminal.render_image([[], []], profile) == ['']
+    assert terminal.render_image([], profile) == []
+
+
 def test_256color():
     env = Environ()
     env.enable_256color()
@@ -69,6 +415,40 @@ def test_256color():
     env.reset()
 
 
+def test_profile():
+    env = Environ()
+    env.enable_color()
+    profile = terminal.get_profile()
+    assert profile is terminal.get_profile()
+    assert profile.depth == terminal.TerminalProfile.ANSI
+    assert terminal.is_color_supported()
+    assert not terminal.is_256color_supported()
+
+    os.environ['TERM'] = 'xterm-256color'
+    assert profile.refresh().depth == terminal.TerminalProfile.ANSI256
+
+    os.environ['COLORTERM'] = 'truecolor'
+    terminal.refresh_profile()
+    assert terminal.get_profile() is not profile
+    assert terminal.get_profile().depth == terminal.TerminalProfile.TRUECOLOR
+    env.reset()
+
+
+def test_override_profile():
+    with terminal.override_profile(depth=0) as profile:
+        assert terminal.get_profile() is profile
+        assert not terminal.is_color_supported()
+        assert str(terminal.red('text')) == 'text'
+
+    with terminal.override_profile(depth=256):
+        assert terminal.is_256color_supported()
+        assert str(terminal.red('text')) == '\x1b[38;5;1mtext\x1b[0;39;49m'
+        assert str(terminal.gray('text')) == '\x1b[38;5;8mtext\x1b[0;39;49m'
+
+    with terminal.override_profile(depth=8):
+        assert str(terminal.red('text')) == '\x1b[31mtext\x1b[0;39;49m'
+
+
 class Environ(object):
     def __init__(self):
         self.term = os.environ.get('TERM', None)
@@ -77,10 +457,12 @@ class Environ(object):
         os.environ['TERMINAL-COLOR'] = 'true'
         os.environ['COLORTERM'] = 'true'
         os.environ['TERM'] = 'xterm-256color'
+        terminal.refresh_profile()
 
     def enable_color(self):
         os.environ['TERMINAL-COLOR'] = 'true'
         os.environ['TERM'] = 'xterm'
+        terminal.refresh_profile()
 
     def reset(self):
         del os.environ['TERMINAL-COLOR']
@@ -88,6 +470,7 @@ class Environ(object):
             del os.environ['COLORTERM']
         if self.term:
             os.environ['TERM'] = self.term
+        terminal.refresh_profile()
 
 
 class TestColor(object):
@@ -112,6 +495,38 @@ class TestColor(object):
         print(s)
         env.reset()
 
+    def test_style(self):
+        s = terminal.Color('text')
+        bold = s.bold
+        assert bold is not s
+        assert s.style is terminal.Style()
+        assert bold.style is terminal.Style(None, None, [1])
+        assert s.bold.red.style is bold.red.style
+        assert s.red.style is terminal.Style('red')
+        assert bold.red.fgcolor == 1
+        assert bold.red.styles == (1,)
+        assert not hasattr(s, '__dict__')
+
+        s.fgcolor = 'red'
+        s.styles = [1]
+        assert s.style is bold.red.style
+
+        profile = terminal.TerminalProfile(depth=8)
+        rv = '\x1b[1m\x1b[31mtext\x1b[0;39;49m\x1b[0;39;49m'
+        assert s.render(profile) == rv
+
+    def test_style_cache_size(self):
+        profile = terminal.TerminalProfile(depth=24)
+        for i in range(color._style_cache_size * 3):
+            s = terminal.Color('text').bold
+            s.fgcolor = (i % 256, i // 256, 0)
+            s.render(profile)
+            (s + terminal.red('a')).render(profile, minimal=True)
+        for cache in (color._style_cache, color._style_wraps,
+                      color._style_chains, color._style_merges):
+            assert len(cache) <= color._style_cache_size
+        assert terminal.Style() is color._plain_style
+
     @raises(AttributeError)
     def test_property_raise(self):
         s = terminal.Color('text')
@@ -134,6 +549,45 @@ class TestColor(object):
         print(foo.green + bar)
         print(bar + foo)
 
+    def test_plus_spans(self):
+        with terminal.override_profile(depth=8):
+            line = terminal.Color('')
+            for i in range(1000):
+                line = line + terminal.red('a') + 'b'
+            assert line._count == 2001
+            assert str(line) == '\x1b[31ma\x1b[0;39;49mb' * 1000
+
+            foo = terminal.Color('foo')
+            bar = foo + 'bar'
+            baz = foo + 'baz'
+            assert str(bar) == 'foobar'
+            assert str(baz) == 'foobaz'
+            assert str(foo) == 'foo'
+
+            line = bar.bold + baz
+            assert str(line) == '\x1b[1mfoobar\x1b[0;39;49mfoobaz'
+            assert len(line) == 12
+
+    def test_plus_threads(self):
+        base = terminal.Color('prefix ')
+        results = {}
+
+        def work(i):
+            for j in range(200):
+                line = base + ('%i-%i' % (i, j))
+                results[i, j] = line
+
+        threads = [threading.Thread(target=work, args=(i,))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with terminal.override_profile(depth=8):
+            for key in results:
+                assert str(results[key]) == 'prefix %i-%i' % key
+            assert str(base) == 'prefix '
+
     @raises(TypeError)
     def test_add_raise(self):
         foo = terminal.Color('foo')
@@ -238,3 +238,10 @@ class TestCommand(object):
             'container -f -v --verbose --no-color bar -t tag --key=what'
         )
         assert 'verbose' in dict(program)
+
+
+def test_pad():
+    from terminal.command import _pad
+    assert _pad('foo', 5) == 'foo  '
+    assert _pad(u'\u4e2d', 5) == u'\u4e2d   '
+    assert _pad('\x1b[31mfoo\x1b[0;39;49m', 5).endswith('m  ')
@@ -1,4 +1,35 @@
-from terminal import Logger
+import gc
+import os
+import sys
+import json
+import weakref
+import threading
+import multiprocessing
+import terminal
+from terminal import Logger, TerminalProfile, override_profile
+from terminal.builtin import Logger as BuiltinLogger
+from terminal.log import format_json, lazy, LogCollector, setup_worker
+from terminal.log import _flush_dedupe_loggers
+from terminal.sink import QueueSink
+from nose.tools import raises
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+
+class NullSink(object):
+    def emit(self, level, text):
+        pass
+
+    def flush(self):
+        pass
 
 
 class TestLogger(object):
@@ -24,6 +55,46 @@ class TestLogger(object):
         log.verbose.start('no start')
         log.verbose.end('no end')
 
+    def test_verbose_state(self):
+        log = Logger(sink=NullSink())
+        verbose = log.verbose
+        assert log.verbose is verbose
+
+        verbose.warn('hidden warn')
+        verbose.error('hidden error')
+        assert log.warn_count == 1
+        assert log.error_count == 1
+        assert verbose.info('hidden') is verbose
+
+        log.config(verbose=True)
+        assert 'info' not in verbose.__dict__
+        verbose.warn('shown warn')
+        assert log.warn_count == 2
+
+        log.start('start')
+        assert verbose._indent == 1
+        verbose.start('no start')
+        verbose.end('no end')
+        log.end()
+        assert log._indent == 0
+
+        verbose.warn_count = 0
+        assert log.warn_count == 0
+
+    def test_verbose_writeln(self):
+        sink = ListSink()
+        log = Logger(sink=sink)
+        verbose = log.verbose
+        assert verbose.writeln('info', 'hidden') is verbose
+        verbose.writeln('warn', 'hidden warn')
+        verbose.writeln('start', 'hidden start')
+        assert sink.lines == []
+        assert log.warn_count == 1
+
+        log.config(verbose=True)
+        assert verbose.writeln('info', 'shown') is verbose
+        assert sink.lines == ['info: shown\n']
+
     def test_log(self):
         log = Logger()
         log.debug('debug message')
@@ -45,3 +116,745 @@ class TestLogger(object):
 
         log.start('start message')
         log.end()
+
+    def test_format_args(self):
+        log = Logger()
+        assert log.message('unknown', '%s: %d', 'foo', 1) == 'foo: 1'
+        assert log.message('unknown', '%(a)s', {'a': 'b'}) == 'b'
+        assert log.message('unknown', '100%', 'done') == '100% done'
+        assert log.message('unknown', lambda: 'foo', 'bar') == 'foo bar'
+        assert log.message('unknown', 'foo', int) == 'foo %s' % int
+
+    def test_lazy(self):
+        calls = []
+
+        def expensive():
+            calls.append(1)
+            return 'foo'
+
+        log = Logger(sink=NullSink())
+        log.config(quiet=True)
+        log.debug(lazy(expensive))
+        log.info('%s', lambda: expensive())
+        assert calls == []
+        assert log.debug('foo') is log
+        log.warn(lazy(expensive))
+        assert calls == [1]
+        log.verbose.info(lazy(expensive))
+        log.config(quiet=False)
+        assert 'debug' not in log.__dict__
+        log.info(lazy(expensive))
+        assert calls == [1, 1]
+        log.verbose.info(lazy(expensive))
+        assert calls == [1, 1]
+        log.config(verbose=True)
+        log.verbose.info(lazy(expensive))
+        assert calls == [1, 1, 1]
+
+    def test_lazy_only(self):
+        calls = []
+
+        class Callable(object):
+            def __call__(self):
+                calls.append(1)
+
+            def __str__(self):
+                return 'callable'
+
+        def func():
+            calls.append(1)
+
+        log = Logger(sink=NullSink())
+        assert log.message('unknown', Callable(), 'foo') == 'callable foo'
+        assert log.message('unknown', func) == str(func)
+        assert log.message('unknown', lambda x: x).startswith('<function')
+        assert calls == []
+        assert log.message('unknown', lazy(str.upper, 'foo')) == 'FOO'
+        assert log.message('unknown', '%s', lazy(len, 'foo')) == '3'
+
+
+class ListSink(object):
+    def __init__(self):
+        self.lines = []
+
+    def emit(self, level, text):
+        self.lines.append(text)
+
+    def flush(self):
+        pass
+
+
+class TestConcurrentLogger(object):
+    def test_config(self):
+        log = Logger(concurrent=True, indent=2)
+        assert log._indent == 2
+        log.warn('foo')
+        log.config(concurrent=False)
+        assert log._indent == 2
+        assert log.warn_count == 1
+
+    def test_threads(self):
+        sink = ListSink()
+        log = Logger(sink=sink, concurrent=True)
+
+        def work(i):
+            log.start('start %i' % i)
+            for j in range(100):
+                log.warn('%i' % i)
+                log.verbose.error('%i' % i)
+            log.end('end %i' % i)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert log._indent == 0
+        assert log.warn_count == 800
+        assert log.error_count == 800
+        assert sink.lines.count('  warn: 3\n') == 100
+
+        log.error_count = 0
+        assert log.error_count == 0
+
+    def test_dead_threads(self):
+        log = Logger(sink=NullSink(), concurrent=True)
+        for i in range(50):
+            t = threading.Thread(target=log.warn, args=('foo',))
+            t.start()
+            t.join()
+        log.warn('foo')
+
+        # the cells of the ended threads are folded into the base
+        assert len(log._counters._cells) <= 2
+        assert log.warn_count == 51
+        assert log.stats()['records']['warn'] == 51
+
+    def test_context(self):
+        try:
+            import contextvars
+        except ImportError:
+            return
+
+        sink = ListSink()
+        log = Logger(sink=sink, concurrent=True)
+        a = contextvars.copy_context()
+        b = contextvars.copy_context()
+
+        # asyncio tasks run in their own copied contexts
+        a.run(log.start, 'a')
+        b.run(log.start, 'b')
+        a.run(log.info, 'a')
+        b.run(log.info, 'b')
+        assert sink.lines[-2:] == ['  info: a\n', '  info: b\n']
+        a.run(log.end)
+        assert a.run(lambda: log._indent) == 0
+        assert b.run(lambda: log._indent) == 1
+        assert log._indent == 0
+
+
+class TestJsonLogger(object):
+    def test_format_json(self):
+        line = format_json('info', 'a "quoted"\n\ttext\x01', 2, 1.5, {
+            'int': 1, 'float': 0.5, 'nan': float('nan'), 'none': None,
+            'bool': True, 'list': [1, 'a'], 'obj': Logger,
+        })
+        assert line.endswith('\n')
+        data = json.loads(line)
+        assert data['ts'] == 1.5
+        assert data['level'] == 'info'
+        assert data['msg'] == 'a "quoted"\n\ttext\x01'
+        assert data['indent'] == 2
+        assert data['int'] == 1
+        assert data['float'] == 0.5
+        assert data['nan'] is None
+        assert data['none'] is None
+        assert data['bool'] is True
+        assert data['list'] == [1, 'a']
+        assert data['obj'] == str(Logger)
+
+        line = format_json('warn', '\x1b[31mred\x1b[0m')
+        assert json.loads(line)['msg'] == 'red'
+
+    def test_json(self):
+        sink = ListSink()
+        log = Logger(sink=sink, json=True, extra={'app': 'test'})
+        log.start('start %s', 'foo')
+        log.info('done', size=10)
+        log.end()
+        first, second = [json.loads(line) for line in sink.lines]
+        assert first['msg'] == 'start foo'
+        assert first['level'] == 'start'
+        assert first['app'] == 'test'
+        assert second['indent'] == 1
+        assert second['size'] == 10
+        assert list(second)[:4] == ['ts', 'level', 'msg', 'indent']
+
+    def test_json_stream(self):
+        sink = ListSink()
+        stream = StringIO()
+        log = BuiltinLogger(sink=sink, json=stream)
+        with override_profile(depth=TerminalProfile.ANSI):
+            log.error('error', code=1)
+        log.flush()
+        assert 'error' in sink.lines[0]
+        assert '\x1b[' in sink.lines[0]
+        data = json.loads(stream.getvalue())
+        assert data['msg'] == 'error'
+        assert data['code'] == 1
+
+        log.config(json=False)
+        log.info('foo')
+        assert len(stream.getvalue().splitlines()) == 1
+
+
+class TestSinks(object):
+    def test_add_sink(self):
+        console = ListSink()
+        log = Logger(sink=console)
+        warns = log.add_sink(ListSink(), 'warn')
+        records = log.add_sink(ListSink(), 'info', 'json')
+        stream = StringIO()
+        log.add_sink(stream, formatter='json')
+
+        log.debug('debug')
+        log.info('info')
+        log.warn('warn')
+        log.flush()
+        assert console.lines == ['debug: debug\n', 'info: info\n',
+                                 'warn: warn\n']
+        assert warns.lines == ['warn: warn\n']
+        assert [json.loads(line)['msg'] for line in records.lines] == [
+            'info', 'warn']
+        assert len(stream.getvalue().splitlines()) == 3
+
+        log.remove_sink(warns)
+        log.warn('warn')
+        assert len(warns.lines) == 1
+
+    def test_format_once(self):
+        calls = []
+
+        def formatter(level, message, indent, timestamp, extra):
+            calls.append(message)
+            return '%s %s %r\n' % (level, message, sorted(extra.items()))
+
+        def summary():
+            calls.append('lazy')
+            return 'foo'
+
+        log = Logger(sink=ListSink(), extra={'app': 'test'})
+        first = log.add_sink(ListSink(), formatter=formatter)
+        second = log.add_sink(ListSink(), formatter=formatter)
+        log.info(lazy(summary), size=1)
+        assert calls == ['lazy', 'foo']
+        assert first.lines == second.lines == [
+            "info foo [('app', 'test'), ('size', 1)]\n"]
+
+    def test_threshold(self):
+        calls = []
+
+        def summary():
+            calls.append(1)
+            return 'foo'
+
+        log = Logger(sink=ListSink(), level='warn')
+        log.add_sink(ListSink(), 'error')
+        assert 'info' in log.__dict__
+        log.info(lazy(summary))
+        log.writeln('info', lazy(summary))
+        assert calls == []
+        log.warn(lazy(summary))
+        assert calls == [1]
+
+        log.add_sink(ListSink(), 'info')
+        assert 'info' not in log.__dict__
+        assert 'debug' in log.__dict__
+        log.info(lazy(summary))
+        assert calls == [1, 1]
+
+    @raises(ValueError)
+    def test_invalid_formatter(self):
+        Logger().add_sink(ListSink(), formatter='xml')
+
+
+class TestSpans(object):
+    def test_spans(self):
+        sink = ListSink()
+        log = Logger(sink=sink, timing=True)
+        log.start('build')
+        for i in range(3):
+            log.start('compile')
+            log.end('compiled %d', i)
+        log.start('link')
+        log.end()
+        log.end('done')
+
+        assert sink.lines[2].startswith('    end: compiled 0 (')
+        assert sink.lines[-1].startswith('  end: done (')
+        assert log._indent == 0
+
+        spans = log.spans()
+        assert len(spans) == 1
+        build = spans[0]
+        assert build['label'] == 'build'
+        assert build['count'] == 1
+        children = dict((n['label'], n) for n in build['children'])
+        assert children['compile']['count'] == 3
+        assert children['compile']['max'] <= children['compile']['total']
+        assert children['link']['count'] == 1
+        assert build['total'] >= children['compile']['total']
+
+        stream = StringIO()
+        log.report_spans(stream)
+        lines = stream.getvalue().splitlines()
+        assert lines[0].startswith('build ')
+        assert '100.0%' in lines[0]
+        assert lines[1].startswith('  ')
+        assert 'x3' in stream.getvalue()
+
+        stream = StringIO()
+        log.report_at_exit(stream, 'json')
+        log._report_at_exit()
+        assert json.loads(stream.getvalue()) == log.spans()
+
+    def test_json_elapsed(self):
+        sink = ListSink()
+        log = Logger(sink=sink, json=True, timing=True)
+        log.start('foo')
+        log.end('bar')
+        record = json.loads(sink.lines[-1])
+        assert record['msg'].startswith('bar (')
+        assert record['elapsed'] >= 0
+
+    def test_unbalanced(self):
+        log = Logger(sink=ListSink(), timing=True)
+        log.end('no start')
+        log.config(timing=False)
+        log.start('foo')
+        log.config(timing=True)
+        log.end()
+        assert log.spans() == []
+
+    def test_threads(self):
+        log = Logger(sink=NullSink(), timing=True, concurrent=True)
+
+        def work():
+            for i in range(50):
+                log.start('task')
+                log.start('step')
+                log.end()
+                log.end()
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        spans = log.spans()
+        assert len(spans) == 1
+        assert spans[0]['count'] == 400
+        assert spans[0]['children'][0]['count'] == 400
+
+
+class TestFilters(object):
+    def test_dedupe(self):
+        sink = ListSink()
+        log = Logger(sink=sink, dedupe=60)
+        for i in range(100):
+            log.warn('retry failed')
+        log.error('fatal %s', 'foo')
+        log.error('fatal %s', 'foo')
+        assert sink.lines == ['warn: retry failed\n', 'error: fatal foo\n']
+        assert log.warn_count == 100
+        assert log.error_count == 2
+        assert log.suppressed == {'warn': 99, 'error': 1}
+
+        log.flush()
+        assert sink.lines[2:] == [
+            'warn: retry failed (repeated 99 times)\n',
+            'error: fatal foo (repeated 1 times)\n',
+        ]
+        log.flush()
+        assert len(sink.lines) == 4
+
+    def test_dedupe_window(self):
+        sink = ListSink()
+        log = Logger(sink=sink, dedupe=60, json=True)
+        log.warn('foo')
+        log.warn('foo')
+        log._recent[('warn', ('foo',))][0] -= 60
+        log.warn('foo')
+        records = [json.loads(line) for line in sink.lines]
+        assert [r['msg'] for r in records] == [
+            'foo', 'foo (repeated 1 times)']
+        assert records[1]['repeated'] == 1
+
+    def test_dedupe_size(self):
+        sink = ListSink()
+        log = Logger(sink=sink, dedupe=60, dedupe_size=2)
+        log.info('a')
+        log.info('a')
+        log.info('b')
+        log.info('c')
+        assert sink.lines == ['info: a\n', 'info: b\n',
+                              'info: a (repeated 1 times)\n', 'info: c\n']
+        log.info([1])
+        log.info([1])
+        assert log.suppressed['info'] == 2
+
+    def test_rate_limit(self):
+        sink = ListSink()
+        log = Logger(sink=sink, rate_limit={'warn': (1, 3)})
+        for i in range(10):
+            log.warn('warn %d', i)
+            log.info('info %d', i)
+        assert len([x for x in sink.lines if x.startswith('warn')]) == 3
+        assert len([x for x in sink.lines if x.startswith('info')]) == 10
+        assert log.warn_count == 10
+        assert log.suppressed == {'warn': 7}
+
+        log._buckets['warn'].tokens = 1
+        log.warn('foo')
+        assert sink.lines[-1] == 'warn: foo (7 more suppressed)\n'
+
+        log.config(rate_limit=None)
+        for i in range(10):
+            log.warn('warn %d', i)
+        assert log.suppressed == {'warn': 7}
+
+    def test_dedupe_rate_limit(self):
+        sink = ListSink()
+        log = Logger(sink=sink, dedupe=60, rate_limit={'warn': (1, 1)},
+                     json=True)
+        log.warn('a')
+        log.warn('b')
+        log._buckets['warn'].tokens = 1
+        log.warn('c', key=1)
+        log.warn('c', key=1)
+        log.flush()
+        records = [json.loads(line) for line in sink.lines]
+        assert [r['msg'] for r in records] == [
+            'a', 'c (1 more suppressed)', 'c (repeated 1 times)']
+        assert records[1]['dropped'] == 1
+        assert 'dropped' not in records[2]
+        assert records[2]['key'] == 1
+        assert records[2]['repeated'] == 1
+
+    def test_dedupe_at_exit(self):
+        sink = ListSink()
+        log = Logger(sink=sink, dedupe=60)
+        log.info('foo')
+        log.info('foo')
+        _flush_dedupe_loggers()
+        assert sink.lines == ['info: foo\n', 'info: foo (repeated 1 times)\n']
+
+        ref = weakref.ref(log)
+        del log
+        gc.collect()
+        assert ref() is None
+
+
+class TestBacklog(object):
+    def test_dump_on_error(self):
+        calls = []
+
+        def summary():
+            calls.append(1)
+            return 'lazy'
+
+        sink = ListSink()
+        log = Logger(sink=sink, quiet=True, backlog=3)
+        log.info('first')
+        log.start('start')
+        log.debug('debug %d', 1)
+        log.verbose.warn('verbose warn')
+        log.info(lazy(summary))
+        assert calls == []
+        assert sink.lines == ['start: start\n']
+        assert log.warn_count == 1
+
+        log.error('error')
+        assert calls == [1]
+        assert sink.lines == [
+            'start: start\n',
+            '  debug: debug 1\n',
+            '  warn: verbose warn\n',
+            '  info: lazy\n',
+            '  error: error\n',
+        ]
+
+        # only the first error dumps the backlog
+        log.info('second')
+        log.error('error')
+        assert len(sink.lines) == 6
+        log.dump_backlog()
+        assert sink.lines[-1] == '  info: second\n'
+        log.dump_backlog()
+        assert len(sink.lines) == 7
+
+    def test_threshold(self):
+        sink = ListSink()
+        log = Logger(sink=sink, level='warn', backlog=10, json=True)
+        log.debug('foo', key='value')
+        assert sink.lines == []
+        log.dump_backlog()
+        record = json.loads(sink.lines[0])
+        assert record['msg'] == 'foo'
+        assert record['key'] == 'value'
+
+        log.config(backlog=None)
+        log.debug('foo')
+        log.dump_backlog()
+        assert len(sink.lines) == 1
+
+
+def _work(i):
+    log = terminal.log
+    log.start('task %d', i)
+    log.info('working')
+    if i % 2:
+        log.warn('odd task')
+    else:
+        log.verbose.error('hidden error')
+    log.end('done')
+    return os.getpid()
+
+
+def _hidden_work(queue):
+    log = setup_worker(queue)
+    log.debug('debug')
+    log.info('info')
+    log.verbose.warn('hidden warn')
+
+
+class TestCollector(object):
+    def test_handle(self):
+        sink = ListSink()
+        log = Logger(sink=sink)
+        log.warn('parent')
+        collector = LogCollector(log, queue=[])
+        collector.handle((1, 'start', 'foo', 0, None, 0, 0))
+        collector.handle((1, 'warn', 'bar', 1, {'a': 1}, 2, 0))
+        collector.handle((2, 'error', 'baz', 0, None, 0, 1))
+        assert sink.lines[1:] == [
+            'start: [1] foo\n', '  warn: [1] bar\n', 'error: [2] baz\n']
+        assert log.warn_count == 3
+        assert log.error_count == 1
+        assert collector.workers[1] == {
+            'records': 2, 'warn_count': 2, 'error_count': 0}
+
+        collector.handle((3, None, None, 0, None, 0, 0))
+        assert 3 not in collector.workers
+        collector.handle((1, None, None, 0, None, 3, 1))
+        assert log.warn_count == 4
+        assert log.error_count == 2
+        assert collector.workers[1]['records'] == 2
+
+    def test_level_filters(self):
+        sink = ListSink()
+        log = Logger(sink=sink, quiet=True)
+        collector = LogCollector(log, queue=[])
+        collector.handle((1, 'debug', 'foo', 0, None, 0, 0))
+        collector.handle((1, 'info', 'bar', 0, None, 0, 0))
+        collector.handle((1, 'warn', 'baz', 0, None, 1, 0))
+        assert sink.lines == ['warn: [1] baz\n']
+        assert log.stats()['suppressed'] == {'debug': 1, 'info': 1}
+
+    def test_final_counters(self):
+        sink = ListSink()
+        log = Logger(sink=sink, quiet=True)
+        with LogCollector(log) as collector:
+            process = multiprocessing.Process(
+                target=_hidden_work, args=(collector.queue,))
+            process.start()
+            process.join()
+
+        assert sink.lines == []
+        assert log.warn_count == 1
+        assert list(collector.workers) == [process.pid]
+
+    def test_queue_sink(self):
+        queue = Queue()
+        log = Logger(sink=QueueSink(queue))
+        log.start('foo %s', 'bar')
+        log.warn('warn', key='value')
+        pid = os.getpid()
+        assert queue.get() == (pid, 'start', 'foo bar', 0, None, 0, 0)
+        assert queue.get() == (pid, 'warn', 'warn', 1, {'key': 'value'},
+                               1, 0)
+
+    def test_pool(self):
+        sink = ListSink()
+        log = Logger(sink=sink)
+        with LogCollector(log) as collector:
+            pool = multiprocessing.Pool(
+                2, initializer=setup_worker, initargs=(collector.queue,))
+            pids = pool.map(_work, range(6))
+            pool.close()
+            pool.join()
+
+        assert log.warn_count == 3
+        assert log.error_count == 3
+        # the hidden errors are counted by the next records
+        assert len(sink.lines) == 21
+        assert set(collector.workers) == set(pids)
+        assert sum(w['records'] for w in collector.workers.values()) == 21
+        for pid in set(pids):
+            lines = [x for x in sink.lines if '[%d]' % pid in x]
+            for line in lines:
+                if 'working' in line or 'odd' in line or 'done' in line:
+                    assert line.startswith('  ')
+                else:
+                    assert line.startswith('start')
+
+
+class TestStats(object):
+    def test_stats(self):
+        stdout = sys.stdout
+        stderr = sys.stderr
+        sys.stdout = StringIO()
+        sys.stderr = StringIO()
+        try:
+            log = Logger(quiet=True, stats_sample=1)
+            log.add_sink(ListSink(), 'warn', 'json')
+            log.info('hidden')
+            log.verbose.warn('hidden')
+            log.warn('warn')
+            log.error('error')
+        finally:
+            sys.stdout = stdout
+            sys.stderr = stderr
+
+        stats = log.stats()
+        assert stats['records'] == {'warn': 1, 'error': 1}
+        assert stats['suppressed'] == {'info': 1, 'warn': 1}
+        assert stats['bytes']['stdout'] == len('warn: warn\n')
+        assert stats['bytes']['stderr'] == len('error: error\n')
+        assert stats['bytes']['ListSink'] > 0
+        assert stats['warn_count'] == 2
+        assert stats['error_count'] == 1
+        assert stats['samples'] == 2
+        assert stats['format_seconds'] > 0
+        assert stats['io_seconds'] > 0
+
+    def test_bytes_utf8(self):
+        log = Logger(sink=NullSink())
+        log.info(u'\u4e2d\u6587')
+        text = u'info: \u4e2d\u6587\n'
+        assert log.stats()['bytes']['NullSink'] == len(text.encode('utf-8'))
+
+    def test_hidden_counts(self):
+        log = Logger(sink=NullSink(), quiet=True)
+        log.debug('foo')
+        log.config(backlog=2)
+        log.debug('foo')
+        log.verbose.info('foo')
+        log.config(quiet=False, verbose=True, backlog=0)
+        log.verbose.info('foo')
+        assert log.suppressed == {'debug': 2, 'info': 1}
+
+    def test_sample(self):
+        log = Logger(sink=NullSink(), stats_sample=4)
+        for i in range(10):
+            log.info('foo')
+        stats = log.stats()
+        assert stats['records'] == {'info': 10}
+        assert stats['samples'] == 2
+        assert stats['bytes'] == {'NullSink': 100}
+
+        log.config(stats_sample=0, concurrent=True)
+        log.info('foo')
+        assert log.stats()['samples'] == 2
+        assert log.stats()['records'] == {'info': 11}
+
+    def test_prometheus(self):
+        log = Logger(sink=NullSink(), level='info')
+        log.debug('foo')
+        log.info('foo')
+        text = log.stats('prometheus')
+        assert '# TYPE terminal_log_records_total counter\n' in text
+        assert 'terminal_log_records_total{level="info"} 1\n' in text
+        assert 'terminal_log_suppressed_total{level="debug"} 1\n' in text
+        assert 'terminal_log_written_bytes_total{stream="NullSink"} 10\n' \
+            in text
+        assert text.endswith('terminal_log_timing_samples_total 0\n')
+
+
+class TestSampling(object):
+    def test_call_site(self):
+        calls = []
+
+        def summary():
+            calls.append(1)
+            return 'lazy'
+
+        sink = ListSink()
+        log = Logger(sink=sink, sample={'debug': 10}, json=True,
+                     verbose=True)
+        for i in range(30):
+            log.debug(lazy(summary))
+            log.verbose.debug('verbose')
+            log.info('info')
+        for i in range(5):
+            log.debug('other site')
+
+        records = [json.loads(line) for line in sink.lines]
+        debugs = [r for r in records if r['level'] == 'debug']
+        assert len(calls) == 3
+        assert sorted(r['msg'] for r in debugs) == [
+            'lazy', 'lazy', 'lazy', 'other site',
+            'verbose', 'verbose', 'verbose']
+        assert all(r['sample_rate'] == 10 for r in debugs)
+        infos = [r for r in records if r['level'] == 'info']
+        assert len(infos) == 30
+        assert 'sample_rate' not in infos[0]
+        assert log.suppressed == {'debug': 58}
+
+    def test_probability(self):
+        sink = ListSink()
+        log = Logger(sink=sink, sample={'info': 0.25}, json=True)
+        for i in range(400):
+            log.info('foo')
+        assert 40 < len(sink.lines) < 160
+        assert json.loads(sink.lines[0])['sample_rate'] == 4
+
+    def test_budget(self):
+        sink = ListSink()
+        log = Logger(sink=sink, sample={'debug': 1}, sample_budget=5)
+        for i in range(20):
+            log.debug('foo')
+        assert len(sink.lines) == 5
+        log.config(sample=None)
+        log.debug('foo')
+        assert len(sink.lines) == 6
+
+    def test_invalid_sample(self):
+        log = Logger(sink=ListSink(), sample={'debug': 10})
+        for value in (0, -1, 0.0, 1.5, -0.5, True, '10'):
+            try:
+                log.config(sample={'debug': value})
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('accepted %r' % (value,))
+        assert log._sampling == {'debug': 10}
+        log.config(sample={'debug': 1.0, 'info': 1})
+
+
+def test_ordered_dict():
+    from terminal.log import _OrderedDict
+    d = _OrderedDict()
+    for key in 'abcd':
+        d[key] = key.upper()
+    d['a'] = 'A'
+    del d['b']
+    d['b'] = 'B'
+    assert d.values() == ['A', 'C', 'D', 'B']
+    assert d.popitem(last=False) == ('a', 'A')
+    assert d.popitem() == ('b', 'B')
+    assert len(d) == 2 and d.get('c') == 'C'
+    d.clear()
+    assert d.values() == [] and not d
@@ -0,0 +1,290 @@
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import time
+import threading
+from terminal import Logger
+from terminal import sink as sink_module
+from terminal.sink import BufferedSink, ConsoleSink, RotatingFileSink
+from nose.tools import raises
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+class SlowStream(StringIO):
+    def __init__(self):
+        StringIO.__init__(self)
+        self.ready = threading.Event()
+
+    def write(self, text):
+        self.ready.wait()
+        return StringIO.write(self, text)
+
+
+def wait_for(func, timeout=5):
+    deadline = time.time() + timeout
+    while not func():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+class TestBufferedSink(object):
+    def test_buffer(self):
+        stream = StringIO()
+        sink = BufferedSink(stream, buffer_size=10, flush_interval=60)
+        sink.emit('info', 'foo\n')
+        assert stream.getvalue() == ''
+        sink.emit('info', 'bar\n')
+        assert stream.getvalue() == ''
+        sink.emit('info', 'baz\n')
+        assert stream.getvalue() == 'foo\nbar\nbaz\n'
+        assert sink.written == 3
+
+        sink.emit('info', 'foo\n')
+        sink.emit('error', 'bar\n')
+        assert stream.getvalue().endswith('baz\nfoo\nbar\n')
+
+        sink.emit('warn', 'foo\n')
+        sink.flush()
+        assert stream.getvalue().endswith('bar\nfoo\n')
+        sink.close()
+
+    def test_flush_interval(self):
+        stream = StringIO()
+        sink = BufferedSink(stream, flush_interval=0)
+        sink.emit('info', 'foo\n')
+        assert stream.getvalue() == 'foo\n'
+        sink.close()
+
+    def test_flush_timer(self):
+        stream = StringIO()
+        sink = BufferedSink(stream, flush_interval=0.01)
+        sink.emit('info', 'foo\n')
+        assert stream.getvalue() == ''
+        wait_for(lambda: stream.getvalue() == 'foo\n')
+        sink.emit('info', 'bar\n')
+        wait_for(lambda: stream.getvalue() == 'foo\nbar\n')
+        sink.close()
+
+    def test_flush_level(self):
+        stream = StringIO()
+        sink = BufferedSink(stream, flush_level='warn', flush_interval=60)
+        sink.emit('info', 'foo\n')
+        sink.emit('warn', 'bar\n')
+        assert stream.getvalue() == 'foo\nbar\n'
+        sink.close()
+
+    def test_stderr(self):
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = StringIO()
+        sys.stderr = StringIO()
+        try:
+            sink = BufferedSink(flush_interval=60)
+            sink.emit('info', 'foo\n')
+            assert sys.stdout.getvalue() == ''
+            sink.emit('error', 'bar\n')
+            assert sys.stdout.getvalue() == 'foo\n'
+            assert sys.stderr.getvalue() == 'bar\n'
+            sink.close()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def test_background(self):
+        stream = StringIO()
+        sink = BufferedSink(stream, background=True, flush_interval=60)
+        for i in range(100):
+            sink.emit('info', '%i\n' % i)
+        sink.flush()
+        assert stream.getvalue() == ''.join('%i\n' % i for i in range(100))
+
+        sink.emit('error', 'error\n')
+        assert stream.getvalue().endswith('99\nerror\n')
+        sink.close()
+        sink.close()
+        assert sink.written == 101
+
+    def test_drop(self):
+        stream = SlowStream()
+        sink = BufferedSink(
+            stream, buffer_size=1, background=True,
+            queue_size=2, policy='drop',
+        )
+        for i in range(10):
+            sink.emit('info', '%i\n' % i)
+        assert sink.dropped >= 7
+
+        stream.ready.set()
+        sink.close()
+        assert sink.written + sink.dropped == 10
+
+    def test_drop_error(self):
+        stream = SlowStream()
+        sink = BufferedSink(
+            stream, buffer_size=1, background=True,
+            queue_size=2, policy='drop',
+        )
+        for i in range(5):
+            sink.emit('info', '%i\n' % i)
+
+        thread = threading.Thread(target=sink.emit, args=('error', 'e\n'))
+        thread.start()
+        thread.join(0.05)
+        assert thread.is_alive()
+
+        stream.ready.set()
+        thread.join()
+        assert stream.getvalue().endswith('e\n')
+        assert sink.written + sink.dropped == 6
+        sink.close()
+
+    @raises(ValueError)
+    def test_policy_raise(self):
+        BufferedSink(policy='ignore')
+
+
+def test_logger_sink():
+    stream = StringIO()
+    sink = BufferedSink(stream, flush_interval=60)
+    log = Logger(sink=sink)
+    log.info('foo')
+    log.warn('bar')
+    assert stream.getvalue() == ''
+    log.flush()
+    assert stream.getvalue() == 'info: foo\nwarn: bar\n'
+
+    log.config(sink=None)
+    assert isinstance(log._sink, ConsoleSink)
+    log.flush()
+
+
+class TestRotatingFileSink(object):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, 'app.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def setup_method(self, method):
+        self.setUp()
+
+    def teardown_method(self, method):
+        self.tearDown()
+
+    def read(self, name):
+        with open(os.path.join(self.dirname, name), 'rb') as f:
+            return f.read()
+
+    def test_write(self):
+        sink = RotatingFileSink(self.path, flush_interval=60)
+        sink.emit('info', '\x1b[31mred\x1b[0m\n')
+        assert self.read('app.log') == b''
+        sink.emit('error', 'error\n')
+        assert self.read('app.log') == b'red\nerror\n'
+        sink.emit('info', 'foo\n')
+        sink.close()
+        sink.close()
+        assert self.read('app.log') == b'red\nerror\nfoo\n'
+
+    def test_flush_timer(self):
+        sink = RotatingFileSink(self.path, flush_interval=0.01)
+        sink.emit('info', 'foo\n')
+        assert self.read('app.log') == b''
+        wait_for(lambda: self.read('app.log') == b'foo\n')
+        sink.close()
+
+    def test_rotate_size(self):
+        sink = RotatingFileSink(self.path, max_bytes=10, backups=2,
+                                buffer_size=1)
+        for i in range(5):
+            sink.emit('info', '%i23456\n' % i)
+        sink.close()
+        assert sorted(os.listdir(self.dirname)) == [
+            'app.log', 'app.log.1', 'app.log.2']
+        assert self.read('app.log') == b'423456\n'
+        assert self.read('app.log.1') == b'323456\n'
+        assert self.read('app.log.2') == b'223456\n'
+
+    def test_rotate_time(self):
+        sink = RotatingFileSink(self.path, interval=60, buffer_size=1)
+        sink.emit('info', 'foo\n')
+        sink._opened_at -= 60
+        sink.emit('info', 'bar\n')
+        sink.close()
+        assert self.read('app.log') == b'bar\n'
+        assert self.read('app.log.1') == b'foo\n'
+
+    def test_compress(self):
+        sink = RotatingFileSink(self.path, max_bytes=10, backups=3,
+                                compress='gzip', buffer_size=1)
+        for i in range(4):
+            sink.emit('info', '%i23456\n' % i)
+        sink.close()
+        assert sorted(os.listdir(self.dirname)) == [
+            'app.log', 'app.log.1.gz', 'app.log.2.gz', 'app.log.3.gz']
+        path = os.path.join(self.dirname, 'app.log.3.gz')
+        with gzip.open(path, 'rb') as f:
+            assert f.read() == b'023456\n'
+
+    def test_compress_background(self):
+        ready = threading.Event()
+        compress_file = sink_module._compress_file
+
+        def slow_compress(source, target, compress):
+            ready.wait()
+            compress_file(source, target, compress)
+
+        sink_module._compress_file = slow_compress
+        try:
+            sink = RotatingFileSink(self.path, max_bytes=10, backups=3,
+                                    compress='gzip', buffer_size=1)
+            # the rotations never wait for the compression
+            for i in range(4):
+                sink.emit('info', '%i23456\n' % i)
+            assert self.read('app.log') == b'323456\n'
+            assert not os.path.exists(self.path + '.1.gz')
+            ready.set()
+            sink.close()
+        finally:
+            sink_module._compress_file = compress_file
+
+        assert sorted(os.listdir(self.dirname)) == [
+            'app.log', 'app.log.1.gz', 'app.log.2.gz', 'app.log.3.gz']
+        path = os.path.join(self.dirname, 'app.log.1.gz')
+        with gzip.open(path, 'rb') as f:
+            assert f.read() == b'223456\n'
+
+    def test_no_backups(self):
+        sink = RotatingFileSink(self.path, max_bytes=10, backups=0,
+                                buffer_size=1)
+        for i in range(3):
+            sink.emit('info', '%i23456\n' % i)
+        sink.close()
+        assert os.listdir(self.dirname) == ['app.log']
+        assert self.read('app.log') == b'223456\n'
+
+    @raises(ValueError)
+    def test_invalid_compress(self):
+        RotatingFileSink(self.path, compress='zip')
+
+
+def test_weak_set():
+    class Item(object):
+        pass
+
+    items = sink_module._WeakSet()
+    a, b = Item(), Item()
+    items.add(a)
+    items.add(b)
+    items.add(a)
+    assert len(items) == 2
+    items.discard(b)
+    items.discard(Item())
+    assert list(items) == [a]
+    del a
+    assert list(items) == []